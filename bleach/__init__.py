@@ -10,7 +10,7 @@ from sanitizer import BleachSanitizer
 
 __version__ = '1.0.0'
 
-__all__ = ['clean', 'linkify']
+__all__ = ['Cleaner', 'clean', 'linkify']
 
 log = logging.getLogger('bleach')
 
@@ -68,24 +68,55 @@ NODE_TEXT = 4  # The numeric ID of a text node in simpletree.
 identity = lambda x: x  # The identity function.
 
 
+class Cleaner(object):
+    """Clean HTML fragments with a fixed whitelist.
+
+    The sanitizer class and the parser are set up once and reused for
+    every fragment, and the whitelists are turned into sets, so the cost
+    of clean() only depends on the input. A Cleaner isn't thread-safe.
+
+    """
+
+    def __init__(self, tags=ALLOWED_TAGS, attributes=ALLOWED_ATTRIBUTES,
+                 styles=ALLOWED_STYLES, strip=False, strip_comments=True):
+        if isinstance(attributes, dict):
+            attributes = dict([(tag, frozenset(names)) for tag, names in
+                               attributes.items()])
+        else:
+            attributes = frozenset(attributes)
+
+        class s(BleachSanitizer):
+            allowed_elements = frozenset(tags)
+            allowed_attributes = attributes
+            allowed_css_properties = frozenset(styles)
+            strip_disallowed_elements = strip
+            strip_html_comments = strip_comments
+
+        self.parser = html5lib.HTMLParser(tokenizer=s)
+
+    def clean(self, text):
+        """Clean an HTML fragment and return it"""
+        if not text:
+            return u''
+        elif text.startswith('<!--'):
+            text = u' ' + text
+
+        return _render(self.parser.parseFragment(text), text).strip()
+
+
 def clean(text, tags=ALLOWED_TAGS, attributes=ALLOWED_ATTRIBUTES,
           styles=ALLOWED_STYLES, strip=False, strip_comments=True):
-    """Clean an HTML fragment and return it"""
-    if not text:
-        return u''
-    elif text.startswith('<!--'):
-        text = u' ' + text
+    """Clean an HTML fragment and return it
 
-    class s(BleachSanitizer):
-        allowed_elements = tags
-        allowed_attributes = attributes
-        allowed_css_properties = styles
-        strip_disallowed_elements = strip
-        strip_html_comments = strip_comments
+    This sets up a new Cleaner for every call. Code which cleans many
+    fragments with the same whitelist should keep its own Cleaner.
 
-    parser = html5lib.HTMLParser(tokenizer=s)
+    """
+    if not text:
+        return u''
 
-    return _render(parser.parseFragment(text), text).strip()
+    cleaner = Cleaner(tags, attributes, styles, strip, strip_comments)
+    return cleaner.clean(text)
 
 
 def linkify(text, nofollow=True, filter_url=identity,
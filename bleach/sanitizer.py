@@ -6,10 +6,27 @@ from html5lib.sanitizer import HTMLSanitizerMixin
 from html5lib.tokenizer import HTMLTokenizer
 
 
+uri_garbage_re = re.compile("[`\000-\040\177-\240\s]+")
+uri_scheme_re = re.compile(r'^[a-z0-9][-+.a-z0-9]*:')
+svg_url_re = re.compile(r'url\s*\(\s*[^#\s][^)]+?\)')
+non_local_href_re = re.compile(r'^\s*[^#\s].*')
+css_url_re = re.compile('url\s*\(\s*[^\s)]+?\s*\)\s*')
+css_gauntlet_re = re.compile("""^([:,;#%.\sa-zA-Z0-9!]|\w-\w|'[\s\w]+"""
+                             """'|"[\s\w]+"|\([\d,\s]+\))*$""")
+css_declarations_re = re.compile("^\s*([-\w]+\s*:[^:;]*(;\s*|$))*$")
+css_property_re = re.compile('([-\w]+)\s*:\s*([^:;]*)')
+
+
 class BleachSanitizerMixin(HTMLSanitizerMixin):
     """Mixin to replace sanitize_token() and sanitize_css()."""
 
-    allowed_svg_properties = []
+    allowed_svg_properties = frozenset()
+    # sets instead of html5lib's lists, for membership tests per token
+    attr_val_is_uri = frozenset(HTMLSanitizerMixin.attr_val_is_uri)
+    svg_attr_val_allows_ref = frozenset(
+        HTMLSanitizerMixin.svg_attr_val_allows_ref)
+    svg_allow_local_href = frozenset(HTMLSanitizerMixin.svg_allow_local_href)
+    allowed_protocols = frozenset(HTMLSanitizerMixin.allowed_protocols)
 
     def sanitize_token(self, token):
         """Sanitize a token either by HTML-encoding or dropping.
@@ -27,32 +44,30 @@ class BleachSanitizerMixin(HTMLSanitizerMixin):
                 if 'data' in token:
                     if isinstance(self.allowed_attributes, dict):
                         allowed_attributes = self.allowed_attributes.get(
-                            token['name'], [])
+                            token['name'], ())
                     else:
                         allowed_attributes = self.allowed_attributes
                     attrs = dict([(name, val) for name, val in
                                   token['data'][::-1]
                                   if name in allowed_attributes])
-                    for attr in self.attr_val_is_uri:
-                        if not attr in attrs:
-                            continue
-                        val_unescaped = re.sub("[`\000-\040\177-\240\s]+", '',
-                                               unescape(attrs[attr])).lower()
-                        # Remove replacement characters from unescaped
-                        # characters.
-                        val_unescaped = val_unescaped.replace(u"\ufffd", "")
-                        if (re.match(r'^[a-z0-9][-+.a-z0-9]*:', val_unescaped)
-                            and (val_unescaped.split(':')[0] not in
-                                 self.allowed_protocols)):
-                            del attrs[attr]
-                    for attr in self.svg_attr_val_allows_ref:
-                        if attr in attrs:
-                            attrs[attr] = re.sub(r'url\s*\(\s*[^#\s][^)]+?\)',
-                                                 ' ',
-                                                 unescape(attrs[attr]))
+                    for attr in attrs.keys():
+                        if attr in self.attr_val_is_uri:
+                            val_unescaped = uri_garbage_re.sub('',
+                                unescape(attrs[attr])).lower()
+                            # Remove replacement characters from unescaped
+                            # characters.
+                            val_unescaped = val_unescaped.replace(u"\ufffd", "")
+                            if (uri_scheme_re.match(val_unescaped)
+                                and (val_unescaped.split(':')[0] not in
+                                     self.allowed_protocols)):
+                                del attrs[attr]
+                                continue
+                        if attr in self.svg_attr_val_allows_ref:
+                            attrs[attr] = svg_url_re.sub(' ',
+                                                         unescape(attrs[attr]))
                     if (token['name'] in self.svg_allow_local_href and
                         'xlink:href' in attrs and
-                        re.search(r'^\s*[^#\s].*', attrs['xlink:href'])):
+                        non_local_href_re.search(attrs['xlink:href'])):
                         del attrs['xlink:href']
                     if 'style' in attrs:
                         attrs['style'] = self.sanitize_css(attrs['style'])
@@ -90,18 +105,16 @@ class BleachSanitizerMixin(HTMLSanitizerMixin):
 
         """
         # disallow urls
-        style = re.compile('url\s*\(\s*[^\s)]+?\s*\)\s*').sub(' ', style)
+        style = css_url_re.sub(' ', style)
 
         # gauntlet
-        if not re.match("""^([:,;#%.\sa-zA-Z0-9!]|\w-\w|'[\s\w]+"""
-                        """'|"[\s\w]+"|\([\d,\s]+\))*$""",
-                        style):
+        if not css_gauntlet_re.match(style):
             return ''
-        if not re.match("^\s*([-\w]+\s*:[^:;]*(;\s*|$))*$", style):
+        if not css_declarations_re.match(style):
             return ''
 
         clean = []
-        for prop, value in re.findall('([-\w]+)\s*:\s*([^:;]*)', style):
+        for prop, value in css_property_re.findall(style):
             if not value:
                 continue
             if prop.lower() in self.allowed_css_properties:
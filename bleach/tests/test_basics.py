@@ -149,3 +149,14 @@ def test_lowercase_html():
     dirty = u'<EM CLASS="FOO">BAR</EM>'
     clean = u'<em class="FOO">BAR</em>'
     eq_(clean, bleach.clean(dirty, attributes=['class']))
+
+
+def test_cleaner_reuse():
+    cleaner = bleach.Cleaner(tags=['span', 'br'],
+                             attributes={'span': ['style']},
+                             styles=['color'])
+    dirty = u'a <br/><span style="color: red;">test</span> <em>b</em>'
+    clean = u'a <br><span style="color: red;">test</span> &lt;em&gt;b&lt;/em&gt;'
+    eq_(clean, cleaner.clean(dirty))
+    eq_(u'', cleaner.clean(u''))
+    eq_(clean, cleaner.clean(dirty))
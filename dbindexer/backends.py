@@ -2,12 +2,68 @@ from django.db import models
 from django.db.models.fields import FieldDoesNotExist
 from django.db.models.sql.constants import JOIN_TYPE, LHS_ALIAS, LHS_JOIN_COL, \
     TABLE_NAME, RHS_JOIN_COL
+from django.db.models.sql.where import AND
+from django.db.utils import DatabaseError
 from django.utils.tree import Node
 from djangotoolbox.fields import ListField
 from .lookups import StandardLookup
+from copy import deepcopy
 
 OR = 'OR'
 
+class ApproximateFilter(Node):
+    '''
+    Replaces the filter of an approximate lookup in the where-tree. Its
+    children narrow down the candidates, the compiler checks the results
+    against the original filter value.
+    '''
+    def __init__(self, lookup, field_name, value, children=None):
+        super(ApproximateFilter, self).__init__(children, AND)
+        self.lookup = lookup
+        self.field_name = field_name
+        self.value = value
+
+    def __deepcopy__(self, memodict):
+        obj = super(ApproximateFilter, self).__deepcopy__(memodict)
+        obj.lookup = self.lookup
+        obj.field_name = self.field_name
+        obj.value = deepcopy(self.value, memodict)
+        return obj
+
+def get_approximate_filters(filters):
+    '''
+    Returns the ApproximateFilters all results have to pass, i.e., the ones
+    which aren't negated or inside an OR.
+    '''
+    result = []
+    if filters.negated or (filters.connector == OR and
+                           len(filters.children) > 1):
+        return result
+    for child in filters.children:
+        if isinstance(child, ApproximateFilter):
+            result.append(child)
+        elif isinstance(child, Node):
+            result.extend(get_approximate_filters(child))
+    return result
+
+def check_approximate_filters(filters, negated=False):
+    '''
+    Raises DatabaseError for ApproximateFilters which are negated or inside
+    an OR. Their candidates can't be verified row by row, so the results
+    would silently be wrong.
+    '''
+    negated = negated or filters.negated or (filters.connector == OR and
+                                             len(filters.children) > 1)
+    for child in filters.children:
+        if isinstance(child, ApproximateFilter):
+            if negated:
+                raise DatabaseError("%s lookups on %s can't be negated or "
+                                    "combined with OR" % (
+                                    '/'.join(child.lookup.lookup_types),
+                                    child.field_name))
+        elif isinstance(child, Node):
+            check_approximate_filters(child, negated)
+
 # TODO: optimize code
 class BaseResolver(object):
     def __init__(self):
@@ -92,8 +148,14 @@ class BaseResolver(object):
                     new_lookup_type, new_value = lookup.convert_lookup(value,
                                                                        lookup_type)
                     index_name = self.index_name(lookup)
-                    self._convert_filter(query, filters, child, index,
-                                         new_lookup_type, new_value, index_name)
+                    if lookup.approximate:
+                        self._convert_approximate_filter(query, filters, child,
+                            index, lookup, field_name, new_lookup_type,
+                            new_value, index_name)
+                    else:
+                        self._convert_filter(query, filters, child, index,
+                                             new_lookup_type, new_value,
+                                             index_name)
         
     def _convert_filter(self, query, filters, child, index, new_lookup_type,
                         new_value, index_name):
@@ -104,6 +166,18 @@ class BaseResolver(object):
         child = constraint, lookup_type, annotation, value
         filters.children[index] = child
     
+    def _convert_approximate_filter(self, query, filters, child, index, lookup,
+                                    field_name, new_lookup_type, new_values,
+                                    index_name):
+        constraint, lookup_type, annotation, value = child
+        constraint.field = query.get_meta().get_field(index_name)
+        constraint.col = constraint.field.column
+        node = ApproximateFilter(lookup, field_name, value)
+        for new_value in new_values:
+            node.children.append((constraint, new_lookup_type, annotation,
+                                  new_value))
+        filters.children[index] = node
+
     def index_name(self, lookup):
         return lookup.index_name
     
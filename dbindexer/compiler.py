@@ -1,5 +1,7 @@
 from .resolver import resolver
+from .backends import get_approximate_filters, check_approximate_filters
 from django.utils.importlib import import_module
+from itertools import chain, islice
 
 def __repr__(self):
     return '<%s, %s, %s, %s>' % (self.alias, self.col, self.field.name,
@@ -17,15 +19,97 @@ Constraint.__repr__ = __repr__
 class BaseCompiler(object):
     def convert_filters(self):
         resolver.convert_filters(self.query)
+        check_approximate_filters(self.query.where)
 
 class SQLCompiler(BaseCompiler):
     def execute_sql(self, *args, **kwargs):
         self.convert_filters()
         return super(SQLCompiler, self).execute_sql(*args, **kwargs)
 
+    def has_results(self):
+        self.convert_filters()
+        return super(SQLCompiler, self).has_results()
+
+    def get_count(self, check_exists=False):
+        if not self.get_result_checks():
+            return super(SQLCompiler, self).get_count(check_exists=check_exists)
+        # the index only narrows down the candidates, so count the ones
+        # which pass the check
+        count = 0
+        for row in self.results_iter():
+            count += 1
+            if check_exists:
+                break
+        return count
+
     def results_iter(self):
         self.convert_filters()
-        return super(SQLCompiler, self).results_iter()
+        checks = self.get_result_checks()
+        if not checks:
+            return super(SQLCompiler, self).results_iter()
+        # the index only narrows down the candidates, so the slice has to be
+        # applied to the verified rows instead of the candidates
+        low_mark, high_mark = self.query.low_mark, self.query.high_mark
+        self.query.clear_limits()
+        try:
+            results = super(SQLCompiler, self).results_iter()
+            if isinstance(results, VerifiedResults):
+                return results
+            # start the query while the limits are cleared
+            results = iter(results)
+            try:
+                first = [results.next()]
+            except StopIteration:
+                first = []
+        finally:
+            self.query.low_mark, self.query.high_mark = low_mark, high_mark
+        width = len(super(SQLCompiler, self).get_fields())
+        rows = (row[:width] for row in chain(first, results)
+                if all([lookup.matches_value(row[position], value)
+                        for position, lookup, value in checks]))
+        return VerifiedResults(islice(rows, low_mark, high_mark))
+
+    def get_fields(self):
+        # the fields of approximate filters get loaded even if the query
+        # doesn't ask for them, results_iter() cuts them off again
+        fields = list(super(SQLCompiler, self).get_fields())
+        names = [field.name for field in fields]
+        for node in get_approximate_filters(self.query.where):
+            if node.field_name not in names:
+                names.append(node.field_name)
+                fields.append(self.query.get_meta().get_field(node.field_name))
+        return fields
+
+    def get_result_checks(self):
+        '''
+        Returns (column position, lookup, filter value) for each approximate
+        filter all results have to pass.
+        '''
+        checks = []
+        approximate_filters = get_approximate_filters(self.query.where)
+        if not approximate_filters:
+            return checks
+        names = [field.name for field in self.get_fields()]
+        for node in approximate_filters:
+            checks.append((names.index(node.field_name), node.lookup,
+                           node.value))
+        return checks
+
+class VerifiedResults(object):
+    '''
+    Rows which already passed the checks of the approximate filters. A
+    backend can hand them back to a later results_iter() call (e.g., the
+    ones djangoappengine's fetch_async() started), so they don't get
+    checked and sliced twice.
+    '''
+    def __init__(self, rows):
+        self.rows = rows
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return self.rows.next()
 
 
 class SQLInsertCompiler(BaseCompiler):
@@ -33,6 +117,11 @@ class SQLInsertCompiler(BaseCompiler):
         resolver.convert_insert_query(self.query)
         return super(SQLInsertCompiler, self).execute_sql(return_id=return_id)
 
+    def execute_many(self, compilers):
+        for compiler in compilers:
+            resolver.convert_insert_query(compiler.query)
+        return super(SQLInsertCompiler, self).execute_many(compilers)
+
 class SQLUpdateCompiler(BaseCompiler):
     pass
 
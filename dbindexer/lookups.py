@@ -19,6 +19,10 @@ class ExtraFieldLookup(object):
     '''Default is to behave like an exact filter on an ExtraField.'''
     __metaclass__ = LookupBase
     lookup_types = 'exact'
+    # Approximate lookups only narrow down the candidates: convert_lookup()
+    # returns a list of values which all have to match and the results get
+    # checked against matches_value() afterwards.
+    approximate = False
     
     def __init__(self, model=None, field_name=None, lookup_def=None,
                  new_lookup='exact', field_to_add=models.CharField(
@@ -60,6 +64,10 @@ class ExtraFieldLookup(object):
     def matches_filter(self, model, field_name, lookup_type, value):
         return self.model == model and lookup_type in self.lookup_types \
             and field_name == self.field_name
+
+    def matches_value(self, field_value, value):
+        '''Checks a result of an approximate lookup.'''
+        return True
     
     @classmethod
     def matches_lookup_def(cls, lookup_def):
@@ -151,6 +159,109 @@ class Icontains(Contains):
     def _convert_lookup(self, value, lookup_type):
         return self.new_lookup, value.lower()
 
+class NgramContains(Contains):
+    '''
+    Alternative to Contains which stores the distinct n-grams of the value
+    (all substrings of length 1 to n) instead of all of its suffixes, so
+    the index grows linearly with the length of the value.
+
+    A query matches the entities which contain a few n-grams covering the
+    searched value, and the results are verified in memory. Thus, the
+    indexed field always gets loaded (e.g., values('pk') queries fetch
+    entities instead of keys), and a sliced query reads candidates until
+    the slice is filled.
+
+    At most max_grams n-grams get stored per value because every one of
+    them is an index entry of the entity. Longer values keep the shorter
+    n-grams, so searching them for a substring whose n-grams got dropped
+    misses the entity.
+
+    It's never picked by name, pass an instance in the register_index
+    mapping instead: register_index(Model, {'title': NgramContains()}).
+    '''
+    lookup_types = 'contains'
+    approximate = True
+    # at most that many n-grams are used per query, the verification
+    # filters out the additional false positives
+    max_query_grams = 5
+
+    def __init__(self, *args, **kwargs):
+        self.n = kwargs.pop('n', 3)
+        self.max_grams = kwargs.pop('max_grams', 5000)
+        defaults = {'new_lookup': 'exact'}
+        defaults.update(kwargs)
+        Contains.__init__(self, *args, **defaults)
+
+    @classmethod
+    def matches_lookup_def(cls, lookup_def):
+        return False
+
+    @property
+    def index_name(self):
+        return 'idxf_%s_l_%s_%igrams' % (self.field_name, self.lookup_types[0],
+                                        self.n)
+
+    def contains_indexer(self, value):
+        grams = set()
+        if value:
+            for length in range(1, self.n + 1):
+                for start in range(len(value) - length + 1):
+                    grams.add(value[start:start + length])
+        if len(grams) > self.max_grams:
+            grams = sorted(grams, key=lambda gram: (len(gram), gram))[
+                :self.max_grams]
+        return sorted(grams)
+
+    def query_grams(self, value):
+        if not value:
+            return []
+        if len(value) <= self.n:
+            return [value]
+        # non-overlapping n-grams plus the last one cover the whole value
+        grams = [value[start:start + self.n]
+                 for start in range(0, len(value) - self.n, self.n)]
+        grams.append(value[-self.n:])
+        result = []
+        for gram in grams:
+            if gram not in result:
+                result.append(gram)
+        if len(result) > self.max_query_grams:
+            # keep the first and the last ones, the middle gets verified
+            result = result[:self.max_query_grams - 1] + result[-1:]
+        return result
+
+    def convert_lookup(self, value, lookup_type):
+        return self.new_lookup, self.query_grams(value)
+
+    def matches_value(self, field_value, value):
+        if field_value is None:
+            return False
+        if isinstance(field_value, (tuple, list)):
+            for item in field_value:
+                if item is not None and value in item:
+                    return True
+            return False
+        return value in field_value
+
+class NgramIcontains(NgramContains):
+    lookup_types = 'icontains'
+
+    def contains_indexer(self, value):
+        if value:
+            value = value.lower()
+        return NgramContains.contains_indexer(self, value)
+
+    def convert_lookup(self, value, lookup_type):
+        return self.new_lookup, self.query_grams(value.lower())
+
+    def matches_value(self, field_value, value):
+        if isinstance(field_value, (tuple, list)):
+            field_value = [item.lower() for item in field_value
+                           if item is not None]
+        elif field_value is not None:
+            field_value = field_value.lower()
+        return NgramContains.matches_value(self, field_value, value.lower())
+
 class Iexact(ExtraFieldLookup):
     lookup_types = 'iexact'
         
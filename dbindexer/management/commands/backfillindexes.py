@@ -0,0 +1,238 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, models, router
+from django.db.models.sql.subqueries import InsertQuery
+from django.utils import simplejson
+from django.utils.importlib import import_module
+from optparse import make_option
+from threading import Thread, Lock
+import os
+import time
+
+from ... import load_indexes
+from ...resolver import resolver
+
+def get_indexed_models():
+    indexed = []
+    for backend in resolver.backends:
+        for lookup in getattr(backend, 'index_map', {}).keys():
+            if lookup.model not in indexed:
+                indexed.append(lookup.model)
+    return indexed
+
+def get_model_label(model):
+    return '%s.%s' % (model._meta.app_label, model._meta.object_name)
+
+class Shard(object):
+    '''
+    Walks over the entities with lower < pk <= upper in pk order. The last
+    processed pk is the position from which a resumed run continues.
+    '''
+    def __init__(self, lower, upper, done=False):
+        self.lower = lower
+        self.upper = upper
+        self.done = done
+        self.count = 0
+
+    def to_json(self):
+        return [self.lower, self.upper, self.done]
+
+    def next_batch(self, model, batch_size):
+        query = model._default_manager.all()
+        if self.lower is not None:
+            query = query.filter(pk__gt=self.lower)
+        if self.upper is not None:
+            query = query.filter(pk__lte=self.upper)
+        return list(query.order_by('pk')[:batch_size])
+
+def save_batch(entities):
+    '''
+    Puts the entities with one batch write if the backend supports it. Like
+    save_base(raw=True) this skips the model's save(), auto_now and
+    friends. The dbindexer insert conversion fills in all registered index
+    fields and as the whole entity gets replaced, index fields which
+    aren't registered anymore get dropped.
+    '''
+    if not entities:
+        return
+    model = entities[0].__class__
+    db = router.db_for_write(model)
+    connection = connections[db]
+    compilers = []
+    for entity in entities:
+        values = [(field, field.get_db_prep_save(getattr(entity, field.attname),
+                                                 connection=connection))
+                  for field in model._meta.local_fields]
+        query = InsertQuery(model)
+        query.insert_values(values)
+        compilers.append(query.get_compiler(using=db))
+    if hasattr(compilers[0], 'execute_many'):
+        compilers[0].execute_many(compilers)
+    else:
+        for compiler in compilers:
+            compiler.execute_sql()
+
+class Backfill(object):
+    def __init__(self, model, shards, batch_size, command):
+        self.model = model
+        self.shards = shards
+        self.batch_size = batch_size
+        self.command = command
+        self.lock = Lock()
+        self.errors = []
+        self.started = time.time()
+
+    @property
+    def count(self):
+        return sum([shard.count for shard in self.shards])
+
+    def run(self):
+        threads = [Thread(target=self.run_shard, args=(shard, ))
+                   for shard in self.shards if not shard.done]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if self.errors:
+            raise CommandError('Backfilling %s failed, rerun with the same '
+                '--state-file to resume: %s' % (get_model_label(self.model),
+                                                self.errors[0]))
+
+    def run_shard(self, shard):
+        try:
+            while not shard.done:
+                entities = shard.next_batch(self.model, self.batch_size)
+                save_batch(self.reread(entities))
+                self.lock.acquire()
+                try:
+                    if entities:
+                        shard.lower = entities[-1].pk
+                        shard.count += len(entities)
+                    if len(entities) < self.batch_size:
+                        shard.done = True
+                    self.command.save_state()
+                    self.report()
+                finally:
+                    self.lock.release()
+        except Exception, e:
+            self.errors.append(e)
+
+    def reread(self, entities):
+        '''
+        Gets the batch again by pk right before the write, on App Engine
+        with a batch get which unlike the query sees all committed edits.
+        Thus, edits made since the batch got read don't get overwritten and
+        deleted entities don't get brought back. An edit between this get
+        and the write can still get lost, but that window is a single batch
+        write instead of one put per entity.
+        '''
+        if not entities:
+            return []
+        current = dict([(entity.pk, entity) for entity in
+            self.model._default_manager.filter(
+                pk__in=[entity.pk for entity in entities])])
+        return [current[entity.pk] for entity in entities
+                if entity.pk in current]
+
+    def report(self):
+        elapsed = max(time.time() - self.started, 0.001)
+        done = len([shard for shard in self.shards if shard.done])
+        self.command.stdout.write('%s: %d entities, %.1f/s, %d/%d shards done\n'
+            % (get_model_label(self.model), self.count, self.count / elapsed,
+               done, len(self.shards)))
+
+class Command(BaseCommand):
+    help = ('Fills in the dbindexer index fields of existing entities and '
+            'removes index fields which aren\'t registered anymore.')
+    args = '[appname.ModelName ...]'
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=100,
+            help='Number of entities to fetch and save per batch.'),
+        make_option('--shards', type='int', dest='shards', default=4,
+            help='Number of pk ranges which get processed in parallel.'),
+        make_option('--state-file', dest='state_file',
+            default='.dbindexer-backfill.json',
+            help='Where to save the progress. An interrupted run resumes '
+                 'from there, delete it to start over.'),
+    )
+
+    def handle(self, *labels, **options):
+        siteconf = getattr(settings, 'AUTOLOAD_SITECONF', None)
+        if siteconf:
+            import_module(siteconf)
+        load_indexes()
+
+        if labels:
+            indexed = []
+            for label in labels:
+                try:
+                    app_label, model_name = label.split('.')
+                except ValueError:
+                    raise CommandError('Expected appname.ModelName, got %s' % label)
+                model = models.get_model(app_label, model_name)
+                if model is None:
+                    raise CommandError('Unknown model: %s' % label)
+                indexed.append(model)
+        else:
+            indexed = get_indexed_models()
+        if not indexed:
+            raise CommandError('No models with dbindexer indexes found.')
+
+        self.state_file = options['state_file']
+        self.state = {}
+        self.backfills = {}
+        if os.path.exists(self.state_file):
+            state_file = open(self.state_file)
+            try:
+                self.state = simplejson.load(state_file)
+            finally:
+                state_file.close()
+            self.stdout.write('Resuming from %s\n' % self.state_file)
+
+        for model in indexed:
+            label = get_model_label(model)
+            if label in self.state:
+                shards = [Shard(*shard) for shard in self.state[label]]
+            else:
+                shards = self.split(model, options['shards'])
+            backfill = Backfill(model, shards, options['batch_size'], self)
+            self.backfills[label] = backfill
+            backfill.run()
+            self.stdout.write('%s: done, %d entities in %.1fs\n' % (label,
+                backfill.count, time.time() - backfill.started))
+
+        if os.path.exists(self.state_file):
+            os.remove(self.state_file)
+
+    def split(self, model, num_shards):
+        '''
+        Splits the pk space into num_shards ranges of equal size. Only
+        integer pks can be split, other models get processed by one shard.
+        '''
+        manager = model._default_manager
+        first = list(manager.order_by('pk').values_list('pk', flat=True)[:1])
+        last = list(manager.order_by('-pk').values_list('pk', flat=True)[:1])
+        if not first:
+            return [Shard(None, None, True)]
+        first, last = first[0], last[0]
+        if num_shards < 2 or not isinstance(first, (int, long)) or \
+                not isinstance(last, (int, long)):
+            return [Shard(None, None)]
+
+        step = max((last - first) // num_shards, 1)
+        bounds = range(first, last, step)[1:num_shards]
+        if not bounds:
+            return [Shard(None, None)]
+        shards = [Shard(None, bounds[0])]
+        for lower, upper in zip(bounds, bounds[1:] + [None]):
+            shards.append(Shard(lower, upper))
+        return shards
+
+    def save_state(self):
+        for label, backfill in self.backfills.items():
+            self.state[label] = [shard.to_json() for shard in backfill.shards]
+        state_file = open(self.state_file, 'w')
+        try:
+            simplejson.dump(self.state, state_file)
+        finally:
+            state_file.close()
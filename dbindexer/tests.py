@@ -1,7 +1,9 @@
 from django.db import models
+from django.db.models import Q
+from django.db.utils import DatabaseError
 from django.test import TestCase
 from .api import register_index
-from .lookups import StandardLookup
+from .lookups import StandardLookup, NgramContains, NgramIcontains
 from .resolver import resolver 
 from djangotoolbox.fields import ListField
 from datetime import datetime
@@ -23,6 +25,10 @@ class Indexed(models.Model):
     foreignkey2 = models.ForeignKey(ForeignIndexed2, related_name='idx_set', null=True)
     tags = ListField(models.CharField(max_length=500, null=True))
 
+class NgramIndexed(models.Model):
+    name = models.CharField(max_length=500)
+    tags = ListField(models.CharField(max_length=500, null=True))
+
 # TODO: add test for foreign key with multiple filters via different and equal paths
 # to do so we have to create some entities matching equal paths but not matching
 # different paths
@@ -207,4 +213,87 @@ class TestIndexed(TestCase):
 #        self.assertEqual(1, ForeignIndexed.objects.filter(name_fi__icontains='Yu').count())
 #
 #        # test icontains on a list
-#        self.assertEqual(2, len(Indexed.objects.all().filter(tags__icontains='RA')))
\ No newline at end of file
+#        self.assertEqual(2, len(Indexed.objects.all().filter(tags__icontains='RA')))
+
+class TestNgramIndexed(TestCase):
+    def setUp(self):
+        self.backends = list(resolver.backends)
+        resolver.backends = []
+        resolver.load_backends(('dbindexer.backends.BaseResolver',
+                                'dbindexer.backends.FKNullFix'))
+        register_index(NgramIndexed, {
+            'name': (NgramContains(), NgramIcontains()),
+            'tags': NgramIcontains(),
+        })
+
+        NgramIndexed(name='YondAimE', tags=('Naruto', 'Jiraya')).save()
+        NgramIndexed(name='Itachi', tags=('Sasuke', 'Madara')).save()
+        # contains all 3-grams of 'abcabc' but not 'abcabc' itself
+        NgramIndexed(name='abcab', tags=('Hinata',)).save()
+
+    def tearDown(self):
+        resolver.backends = self.backends
+
+    def test_index_size(self):
+        grams = NgramContains(n=3).contains_indexer('abcabc')
+        self.assertEqual(['a', 'ab', 'abc', 'b', 'bc', 'bca', 'c', 'ca', 'cab'],
+                         grams)
+
+    def test_contains(self):
+        self.assertEqual(1, len(NgramIndexed.objects.filter(name__contains='Aim')))
+        self.assertEqual(0, len(NgramIndexed.objects.filter(name__contains='aim')))
+        self.assertEqual(1, len(NgramIndexed.objects.filter(name__contains='ndAimE')))
+        # shorter than an n-gram
+        self.assertEqual(2, len(NgramIndexed.objects.filter(name__contains='a')))
+        self.assertEqual(3, len(NgramIndexed.objects.filter(name__contains='')))
+
+    def test_icontains(self):
+        self.assertEqual(1, len(NgramIndexed.objects.filter(name__icontains='aim')))
+        self.assertEqual(1, len(NgramIndexed.objects.filter(
+            name__icontains='yondaime')))
+
+        # test icontains on a list
+        self.assertEqual(2, len(NgramIndexed.objects.filter(tags__icontains='RA')))
+
+    def test_verification(self):
+        self.assertEqual(0, len(NgramIndexed.objects.filter(name__contains='abcabc')))
+        self.assertEqual(1, len(NgramIndexed.objects.filter(name__contains='abca')))
+
+    def test_max_grams(self):
+        grams = NgramContains(n=3, max_grams=5).contains_indexer('abcabc')
+        self.assertEqual(['a', 'ab', 'b', 'bc', 'c'], grams)
+
+    def test_values(self):
+        self.assertEqual([], list(NgramIndexed.objects.filter(
+            name__contains='abcabc').values_list('pk', flat=True)))
+        self.assertEqual([], list(NgramIndexed.objects.filter(
+            name__contains='abcabc').values('pk')))
+        self.assertEqual([['Hinata']], list(NgramIndexed.objects.filter(
+            name__contains='abca').values_list('tags', flat=True)))
+
+    def test_slice(self):
+        NgramIndexed(name='abcabc').save()
+        # 'abcab' is the first candidate but doesn't match
+        self.assertEqual(['abcabc'], list(NgramIndexed.objects.filter(
+            name__contains='abcabc').order_by('name').values_list(
+            'name', flat=True)[:1]))
+        self.assertEqual([], list(NgramIndexed.objects.filter(
+            name__contains='abcabc').order_by('name')[1:]))
+
+    def test_count(self):
+        self.assertEqual(0, NgramIndexed.objects.filter(
+            name__contains='abcabc').count())
+        self.assertEqual(1, NgramIndexed.objects.filter(
+            name__contains='abca').count())
+        self.assertEqual(2, NgramIndexed.objects.filter(
+            tags__icontains='RA').count())
+        self.assertFalse(NgramIndexed.objects.filter(
+            name__contains='abcabc').exists())
+        self.assertTrue(NgramIndexed.objects.filter(
+            name__contains='abca').exists())
+
+    def test_exclude(self):
+        self.assertRaises(DatabaseError, len,
+            NgramIndexed.objects.exclude(name__contains='abcabc'))
+        self.assertRaises(DatabaseError, len, NgramIndexed.objects.filter(
+            Q(name__contains='abca') | Q(name='Itachi')))
@@ -1,7 +1,10 @@
 from .db_settings import get_model_indexes
 
 import datetime
+import inspect
+import itertools
 import sys
+from types import NoneType
 
 from django.db.models.sql import aggregates as sqlaggregates
 from django.db.models.sql.constants import LOOKUP_SEP, MULTI, SINGLE
@@ -13,7 +16,13 @@ from functools import wraps
 
 from google.appengine.api.datastore import Entity, Query, MultiQuery, \
     Put, Get, Delete, Key
-from google.appengine.api.datastore_errors import Error as GAEError
+from google.appengine.api.datastore_errors import Error as GAEError, \
+    NeedIndexError
+try:
+    from google.appengine.api.datastore import GetAsync
+except ImportError:
+    # older SDKs only have the blocking Get()
+    GetAsync = None
 from google.appengine.api.datastore_types import Text, Category, Email, Link, \
     PhoneNumber, PostalAddress, Text, Blob, ByteString, GeoPt, IM, Key, \
     Rating, BlobKey
@@ -25,6 +34,20 @@ import cPickle as pickle
 
 import decimal
 
+# projection queries are available since SDK 1.6.6
+PROJECTION_SUPPORTED = 'projection' in inspect.getargspec(Query.__init__)[0]
+
+# db_types whose values can be read from an index as they are. Lists would
+# return one result per list item and long texts and blobs aren't indexed.
+PROJECTED_DB_TYPES = ('text', 'integer', 'long', 'float', 'bool')
+
+# the datastore gets at most this many entities per batch get
+MAX_GET_BATCH_SIZE = 1000
+
+# (kind, projection, filters, ordering) of projection queries which failed
+# for lack of a composite index and get run as normal queries instead
+_unsupported_projections = set()
+
 # Valid query types (a dictionary is used for speedy lookups).
 OPERATORS_MAP = {
     'exact': '=',
@@ -87,47 +110,43 @@ class GAEQuery(NonrelQuery):
 
     @safe_call
     def fetch(self, low_mark, high_mark):
-        query = self._build_query()
-        executed = False
+        """
+        Sends the datastore RPC right away and returns an iterator over the
+        results, which waits for the RPC only when it gets iterated. This
+        way, several queries can be started before any of them is
+        collected (see djangoappengine.db.utils.fetch_async).
+        """
         if self.excluded_pks and high_mark is not None:
             high_mark += len(self.excluded_pks)
         if self.pk_filters is not None:
-            results = self.get_matching_pk(low_mark, high_mark)
-        else:
-            if high_mark is None:
-                kw = {}
-                if low_mark:
-                    kw['offset'] = low_mark
-                results = query.Run(**kw)
-                executed = True
-            elif high_mark > low_mark:
-                results = query.Get(high_mark - low_mark, low_mark)
-                executed = True
-            else:
-                results = ()
-
-        for entity in results:
-            if isinstance(entity, Key):
-                key = entity
-            else:
-                key = entity.key()
-            if key in self.excluded_pks:
-                continue
-            yield self._make_entity(entity)
-
-        if executed and not isinstance(query, MultiQuery):
-            self.query._gae_cursor = query.GetCompiledCursor()
+            batches = self._start_gets()
+            return self._iter_results(
+                self._iter_matching_pk(low_mark, high_mark, batches))
+        if high_mark is not None and high_mark <= low_mark:
+            return iter(())
+
+        projection = self._get_projection()
+        results = self._run(projection, low_mark, high_mark)
+        if projection:
+            results = self._iter_projected(results, projection, low_mark,
+                                           high_mark)
+        return self._iter_results(results)
 
     @safe_call
     def count(self, limit=None):
         if self.pk_filters is not None:
             return len(self.get_matching_pk(0, limit))
+        # Count() stops at 1000 by default, None counts everything
+        if limit is None:
+            count_limit = None
+        else:
+            count_limit = limit + len(self.excluded_pks)
+        count = self._build_query().Count(limit=count_limit)
         if self.excluded_pks:
-            return len(list(self.fetch(0, 2000)))
-        kw = {}
+            count -= self._count_matching_excluded()
         if limit is not None:
-            kw['limit'] = limit
-        return self._build_query().Count(**kw)
+            count = min(count, limit)
+        return count
 
     @safe_call
     def delete(self):
@@ -293,6 +312,87 @@ class GAEQuery(NonrelQuery):
                 combined.append(self.gae_query[0])
         self.gae_query = combined
 
+    def _get_projection(self):
+        """
+        Returns the columns to fetch with a projection query, or None if
+        whole entities have to be fetched. Only queries for some of the
+        fields get projected, e.g. values() and values_list() queries, and
+        only if they ask for a single indexed and single-valued field
+        besides the primary key. Projecting more than one property, or
+        filtering or sorting on another one, needs a composite index, so
+        those queries fetch entities. Note that an entity which lacks the
+        property, e.g. because it was saved before the field was added,
+        isn't in the index and thus isn't returned by a projection query.
+        """
+        if not PROJECTION_SUPPORTED or self.pks_only:
+            return None
+        if getattr(self.query, '_gae_start_cursor', None) is not None or \
+                getattr(self.query, '_gae_end_cursor', None) is not None:
+            # cursors only work with queries of the same shape
+            return None
+        opts = self.query.get_meta()
+        if len(self.fields) >= len(opts.fields):
+            return None
+
+        unindexed = get_model_indexes(self.query.model)['unindexed']
+        projection = []
+        for field in self.fields:
+            if field.primary_key:
+                continue
+            if field.name in unindexed or field.db_type(
+                    connection=self.connection) not in PROJECTED_DB_TYPES:
+                return None
+            projection.append(field.column)
+        if len(projection) != 1:
+            return None
+
+        # the built-in single-property index only serves queries which
+        # filter and sort on the projected property. and the datastore
+        # doesn't project properties with equality filters
+        for query in self.gae_query:
+            for key in query.keys():
+                column, op = key.split(' ', 1)
+                if column not in projection or op == '=':
+                    return None
+        for column, direction in self.gae_ordering:
+            if column not in projection:
+                return None
+        projection = tuple(projection)
+        if self._projection_signature(projection) in _unsupported_projections:
+            return None
+        return projection
+
+    def _projection_signature(self, projection):
+        filters = tuple([tuple(sorted(query.keys())) for query in self.gae_query])
+        return (self.db_table, projection, filters, tuple(self.gae_ordering))
+
+    def _count_matching_excluded(self):
+        """
+        Returns how many of the excluded keys match the other filters, i.e.
+        how many entities Count() counted which must not be counted.
+        """
+        runs = []
+        for key in set(self.excluded_pks):
+            if key is None:
+                continue
+            key_runs = []
+            for query in self.gae_query:
+                key_query = Query(self.db_table, keys_only=True)
+                key_query.update(query)
+                key_query['__key__ ='] = key
+                # Run() sends the RPC right away, so all lookups run in
+                # parallel
+                key_runs.append(key_query.Run(limit=1))
+            runs.append(key_runs)
+
+        matching = 0
+        for key_runs in runs:
+            for results in key_runs:
+                if list(results):
+                    matching += 1
+                    break
+        return matching
+
     def _make_entity(self, entity):
         if isinstance(entity, Key):
             key = entity
@@ -304,34 +404,168 @@ class GAEQuery(NonrelQuery):
         return entity
 
     @safe_call
-    def _build_query(self):
-        for query in self.gae_query:
+    def _build_query(self, projection=None, cursor=None):
+        gae_query = self.gae_query
+        if projection or cursor is not None:
+            kw = {}
+            if projection:
+                kw['projection'] = projection
+            if cursor is not None:
+                kw['cursor'] = cursor
+                kw['end_cursor'] = getattr(self.query, '_gae_end_cursor', None)
+            gae_query = []
+            for query in self.gae_query:
+                copy = Query(self.db_table, keys_only=self.pks_only, **kw)
+                copy.update(query)
+                gae_query.append(copy)
+        for query in gae_query:
             query.Order(*self.gae_ordering)
-        if len(self.gae_query) > 1:
-            return MultiQuery(self.gae_query, self.gae_ordering)
-        return self.gae_query[0]
+        if len(gae_query) > 1:
+            return MultiQuery(gae_query, self.gae_ordering)
+        return gae_query[0]
+
+    def _run(self, projection, low_mark, high_mark):
+        """
+        Sends the query and returns an iterator over its entities. Unlike
+        Get(), Run() doesn't block until the first batch arrives.
+        """
+        query = self._build_query(projection)
+        chunk_size = getattr(self.query, '_gae_chunk_size', None)
+        if chunk_size and not isinstance(query, MultiQuery):
+            limit = None
+            if high_mark is not None:
+                limit = high_mark - low_mark
+            requested, results = self._run_chunk(query, low_mark, limit,
+                                                 chunk_size)
+            return self._iter_chunks(query, projection, results, requested,
+                                     limit, chunk_size)
 
-    def get_matching_pk(self, low_mark=0, high_mark=None):
+        kw = {}
+        if low_mark:
+            kw['offset'] = low_mark
+        if high_mark is not None:
+            kw['limit'] = high_mark - low_mark
+        return self._iter_run(query, query.Run(**kw))
+
+    def _iter_run(self, query, results):
+        for entity in results:
+            yield entity
+        if not isinstance(query, MultiQuery):
+            self.query._gae_cursor = query.GetCompiledCursor()
+
+    def _run_chunk(self, query, offset, limit, chunk_size):
+        requested = chunk_size
+        if limit is not None:
+            requested = min(chunk_size, limit)
+        kw = {'limit': requested}
+        if offset:
+            kw['offset'] = offset
+        return requested, query.Run(**kw)
+
+    def _iter_chunks(self, query, projection, results, requested, limit,
+                     chunk_size):
+        """
+        Yields the entities of one chunk after the other. The RPC for the
+        next chunk gets sent before the current chunk is yielded, so it
+        runs while the caller processes the current one. At most two
+        chunks are in memory at any time.
+        """
+        while True:
+            chunk = list(results)
+            cursor = query.GetCompiledCursor()
+            self.query._gae_cursor = cursor
+            if limit is not None:
+                limit -= len(chunk)
+            more = len(chunk) == requested and limit != 0
+            if more:
+                query = self._build_query(projection, cursor)
+                requested, results = self._run_chunk(query, 0, limit,
+                                                     chunk_size)
+            for entity in chunk:
+                yield entity
+            if not more:
+                break
+
+    def _iter_projected(self, results, projection, low_mark, high_mark):
+        results = iter(results)
+        try:
+            first = [results.next()]
+        except StopIteration:
+            first = []
+        except NeedIndexError:
+            _unsupported_projections.add(self._projection_signature(projection))
+            results = self._run(None, low_mark, high_mark)
+            first = []
+        return itertools.chain(first, results)
+
+    def _iter_results(self, results):
+        for entity in results:
+            if isinstance(entity, Key):
+                key = entity
+            else:
+                key = entity.key()
+            if key in self.excluded_pks:
+                continue
+            yield self._make_entity(entity)
+
+    def _iter_matching_pk(self, low_mark, high_mark, batches):
+        for result in self.get_matching_pk(low_mark, high_mark, batches):
+            yield result
+
+    def _start_gets(self):
+        """
+        Splits the pk filters into batch gets which run in parallel. Returns
+        the batches for _collect_gets().
+        """
+        keys = []
+        seen = set()
+        for key in self.pk_filters or ():
+            if key is not None and key not in seen:
+                seen.add(key)
+                keys.append(key)
+
+        batches = []
+        for start in range(0, len(keys), MAX_GET_BATCH_SIZE):
+            batch = keys[start:start + MAX_GET_BATCH_SIZE]
+            if GetAsync is not None:
+                batch = GetAsync(batch)
+            batches.append(batch)
+        return batches
+
+    def _collect_gets(self, batches):
+        for batch in batches:
+            if GetAsync is not None:
+                entities = batch.get_result()
+            else:
+                entities = Get(batch)
+            for entity in entities:
+                yield entity
+
+    def get_matching_pk(self, low_mark=0, high_mark=None, batches=None):
         if not self.pk_filters:
             return []
 
-        results = [result for result in Get(self.pk_filters)
-                   if result is not None and
-                       self.matches_filters(result)]
+        if batches is None:
+            batches = self._start_gets()
+        results = []
+        for entity in self._collect_gets(batches):
+            if entity is None or not self.matches_filters(entity):
+                continue
+            results.append(entity)
+            # without ordering, the results are in the order of the keys,
+            # so the rest can't end up within the marks
+            if not self.ordering and high_mark is not None and \
+                    len(results) >= high_mark:
+                break
         if self.ordering:
-            results.sort(cmp=self.order_pk_filtered)
-        if high_mark is not None and high_mark < len(results) - 1:
-            results = results[:high_mark]
-        if low_mark:
-            results = results[low_mark:]
-        return results
+            results = self._sort_in_memory(results, high_mark)
+        return results[low_mark:high_mark]
 
-    def order_pk_filtered(self, lhs, rhs):
-        left = dict(lhs)
-        left[self.query.get_meta().pk.column] = lhs.key().to_path()
-        right = dict(rhs)
-        right[self.query.get_meta().pk.column] = rhs.key().to_path()
-        return self._order_in_memory(left, right)
+    def _get_order_value(self, entity, column):
+        pk = self.query.get_meta().pk
+        if column in (pk.name, pk.column):
+            return entity.key().to_path()
+        return entity.get(column)
 
     def matches_filters(self, entity):
         item = dict(entity)
@@ -348,6 +582,56 @@ class SQLCompiler(NonrelCompiler):
     """
     query_class = GAEQuery
 
+    def results_iter(self):
+        """
+        Like NonrelCompiler.results_iter(), but the query gets sent as soon
+        as this is called instead of on the first iteration. Results which
+        fetch_async() started earlier for the same query are used as is.
+        """
+        started = getattr(self.query, '_gae_started_results', None)
+        if started is not None:
+            del self.query._gae_started_results
+            return started
+        self.check_query()
+        fields = self.get_fields()
+        entities = self.build_query(fields).fetch(self.query.low_mark,
+                                                  self.query.high_mark)
+        return self._make_results(entities, fields)
+
+    def _make_results(self, entities, fields):
+        for entity in entities:
+            yield self._make_result(entity, fields)
+
+    def get_value_converter(self, db_type):
+        convert_value_from_db = self.convert_value_from_db
+        if db_type.startswith(('ListField:', 'SetField:')):
+            convert_item = self.get_value_converter(db_type.split(':', 1)[1])
+            is_set = db_type.startswith('SetField:')
+            def convert(value):
+                if not isinstance(value, (list, tuple, set)):
+                    return convert_value_from_db(db_type, value)
+                value = [convert_item(item) for item in value]
+                if is_set:
+                    value = set(value)
+                return value
+            return convert
+
+        if db_type.startswith(('DictField:', 'decimal')):
+            def convert(value):
+                return convert_value_from_db(db_type, value)
+            return convert
+
+        # values of these types come back from convert_value_from_db() as
+        # they are, so they skip it
+        unchanged = (NoneType, int, long, float, bool, unicode)
+        if db_type not in ('date', 'time'):
+            unchanged += (datetime.datetime, )
+        def convert(value):
+            if type(value) in unchanged:
+                return value
+            return convert_value_from_db(db_type, value)
+        return convert
+
     def convert_value_from_db(self, db_type, value):
         if isinstance(value, (list, tuple, set)) and \
                 db_type.startswith(('ListField:', 'SetField:')):
@@ -440,9 +724,26 @@ class SQLCompiler(NonrelCompiler):
             value = to_datetime(value)
         return value
 
+# maximum number of entities per batch put
+MAX_PUT_BATCH_SIZE = 500
+
 class SQLInsertCompiler(NonrelInsertCompiler, SQLCompiler):
     @safe_call
     def insert(self, data, return_id=False):
+        key = Put(self.make_entity(data))
+        return key.id_or_name()
+
+    @safe_call
+    def execute_many(self, compilers):
+        entities = [compiler.make_entity(compiler.get_insert_data())
+                    for compiler in compilers]
+        ids = []
+        for start in range(0, len(entities), MAX_PUT_BATCH_SIZE):
+            keys = Put(entities[start:start + MAX_PUT_BATCH_SIZE])
+            ids.extend([key.id_or_name() for key in keys])
+        return ids
+
+    def make_entity(self, data):
         gae_data = {}
         opts = self.query.get_meta()
         unindexed_fields = get_model_indexes(self.query.model)['unindexed']
@@ -464,8 +765,7 @@ class SQLInsertCompiler(NonrelInsertCompiler, SQLCompiler):
 
         entity = Entity(self.query.get_meta().db_table, **kwds)
         entity.update(gae_data)
-        key = Put(entity)
-        return key.id_or_name()
+        return entity
 
 class SQLUpdateCompiler(NonrelUpdateCompiler, SQLCompiler):
     pass
@@ -5,6 +5,7 @@ class CursorQueryMixin(object):
         kwargs['_gae_cursor'] = getattr(self, '_gae_cursor', None)
         kwargs['_gae_start_cursor'] = getattr(self, '_gae_start_cursor', None)
         kwargs['_gae_end_cursor'] = getattr(self, '_gae_end_cursor', None)
+        kwargs['_gae_chunk_size'] = getattr(self, '_gae_chunk_size', None)
         return super(CursorQueryMixin, self).clone(*args, **kwargs)
 
 def get_cursor(queryset):
@@ -13,13 +14,17 @@ def get_cursor(queryset):
     cursor = getattr(queryset.query, '_gae_cursor', None)
     return Cursor.to_websafe_string(cursor)
 
-def set_cursor(queryset, start=None, end=None):
+def _with_cursor_query(queryset):
     queryset = queryset.all()
 
     class CursorQuery(CursorQueryMixin, queryset.query.__class__):
         pass
 
     queryset.query = queryset.query.clone(klass=CursorQuery)
+    return queryset
+
+def set_cursor(queryset, start=None, end=None):
+    queryset = _with_cursor_query(queryset)
     if start is not None:
         start = Cursor.from_websafe_string(start)
     queryset.query._gae_start_cursor = start
@@ -27,3 +32,39 @@ def set_cursor(queryset, start=None, end=None):
         end = Cursor.from_websafe_string(end)
     queryset.query._gae_end_cursor = end
     return queryset
+
+def iterate_in_chunks(queryset, chunk_size=500):
+    """
+    Streams the results of queryset without caching them, fetching
+    chunk_size entities per RPC. The next chunk's RPC runs while the
+    current chunk gets processed, so even a loop over all entities of a
+    kind keeps a flat memory footprint.
+    """
+    queryset = _with_cursor_query(queryset)
+    queryset.query._gae_chunk_size = chunk_size
+    return queryset.iterator()
+
+class QueryFuture(object):
+    def __init__(self, queryset):
+        self.queryset = queryset
+
+    def get_result(self):
+        """
+        Waits for the query's RPC and returns the list of results.
+        """
+        return list(self.queryset)
+
+    def __iter__(self):
+        return iter(self.get_result())
+
+def fetch_async(queryset):
+    """
+    Sends the query of the given QuerySet to the datastore without waiting
+    for the results and returns a QueryFuture. Start all independent
+    queries first and call get_result() afterwards, so that their RPCs
+    run in parallel.
+    """
+    queryset = queryset.all()
+    compiler = queryset.query.get_compiler(using=queryset.db)
+    queryset.query._gae_started_results = compiler.results_iter()
+    return QueryFuture(queryset)
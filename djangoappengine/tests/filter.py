@@ -1,4 +1,5 @@
-from ..db.utils import get_cursor, set_cursor
+from ..db.compiler import PROJECTION_SUPPORTED
+from ..db.utils import get_cursor, set_cursor, iterate_in_chunks
 from .testmodels import FieldsWithOptionsModel, EmailModel, DateTimeModel, \
     OrderedModel, BlobModel
 from django.db import models
@@ -197,6 +198,77 @@ class FilterTest(TestCase):
                            .order_by('pk')],
                           [1, 4])
 
+    def test_exclude_pk_count(self):
+        self.assertEquals(OrderedModel.objects.exclude(pk__in=[2, 3]).count(), 2)
+        self.assertEquals(OrderedModel.objects.exclude(pk=10).count(), 4)
+        # only the excluded entities which match the filter don't count
+        self.assertEquals(OrderedModel.objects.filter(priority__gte=1).exclude(
+                          pk__in=[1, 3]).count(), 2)
+        self.assertEquals(OrderedModel.objects.exclude(pk=2)[:2].count(), 2)
+
+    def test_count_past_default_limit(self):
+        # Count() used to stop at 1000 entities
+        for priority in range(4, 1005):
+            OrderedModel(priority=priority, pk=priority + 1).save()
+        self.assertEquals(OrderedModel.objects.count(), 1005)
+        self.assertEquals(OrderedModel.objects.exclude(pk=2).count(), 1004)
+
+    def test_pk_in(self):
+        self.assertEquals([entity.pk for entity in
+                           OrderedModel.objects.filter(pk__in=[1, 2, 3, 4])],
+                          [4, 3, 2, 1])
+        self.assertEquals([entity.pk for entity in
+                           OrderedModel.objects.filter(pk__in=[1, 2, 3, 4])[:3]],
+                          [4, 3, 2])
+        self.assertEquals([entity.pk for entity in
+                           OrderedModel.objects.filter(pk__in=[1, 2, 3, 4])
+                           .order_by('priority')[1:3]],
+                          [2, 3])
+        # every entity is returned once
+        self.assertEquals([entity.pk for entity in
+                           OrderedModel.objects.filter(pk__in=[4, 1, 4])],
+                          [4, 1])
+
+    def test_iterate_in_chunks(self):
+        self.assertEquals([entity.priority for entity in iterate_in_chunks(
+                           OrderedModel.objects.order_by('priority'), 3)],
+                          [0, 1, 2, 3])
+        self.assertEquals([entity.priority for entity in iterate_in_chunks(
+                           OrderedModel.objects.order_by('priority')[1:4], 2)],
+                          [1, 2, 3])
+
+    def test_values_list(self):
+        self.assertEquals(list(OrderedModel.objects.order_by('priority')
+                               .values_list('priority', flat=True)),
+                          [0, 1, 2, 3])
+        self.assertEquals(list(FieldsWithOptionsModel.objects.filter(
+                               email__startswith='r').order_by('email')
+                               .values_list('email', 'integer')),
+                          [(u'rasengan@naruto.com', 1), (u'rinnengan@sage.de', 9)])
+        # equality filters on projected properties need the whole entity
+        self.assertEquals(list(OrderedModel.objects.filter(priority=2)
+                               .values('pk', 'priority')),
+                          [{'pk': 3, 'priority': 2}])
+
+    def test_projection_needs_no_composite_index(self):
+        def projection(queryset):
+            compiler = queryset.query.get_compiler(using='default')
+            return compiler.build_query()._get_projection()
+        if not PROJECTION_SUPPORTED:
+            return
+        self.assertEquals(projection(OrderedModel.objects.order_by('priority')
+                                     .values_list('pk', 'priority')),
+                          ('priority',))
+        # these would need a composite index
+        self.assertEquals(projection(FieldsWithOptionsModel.objects
+                                     .values_list('text', 'integer')), None)
+        self.assertEquals(projection(FieldsWithOptionsModel.objects
+                                     .filter(integer=2)
+                                     .values_list('text', flat=True)), None)
+        self.assertEquals(projection(FieldsWithOptionsModel.objects
+                                     .order_by('integer')
+                                     .values_list('text', flat=True)), None)
+
     def test_chained_filter(self):
         # additionally tests count :)
         self.assertEquals(FieldsWithOptionsModel.objects.filter(
@@ -6,6 +6,7 @@ from django.db.models.sql.constants import LOOKUP_SEP, MULTI, SINGLE
 from django.db.models.sql.where import AND, OR, Constraint
 from django.db.utils import DatabaseError, IntegrityError
 from django.utils.tree import Node
+import heapq
 import random
 
 EMULATED_OPS = {
@@ -21,6 +22,34 @@ EMULATED_OPS = {
     'gte': lambda x, y: x >= y,
 }
 
+class ReversedKey(object):
+    """
+    Wraps a sort key value so that it sorts in descending order, e.g. within
+    a tuple of sort keys with mixed directions.
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __ne__(self, other):
+        return self.value != other.value
+
+    def __lt__(self, other):
+        return self.value > other.value
+
+    def __le__(self, other):
+        return self.value >= other.value
+
+    def __gt__(self, other):
+        return self.value < other.value
+
+    def __ge__(self, other):
+        return self.value <= other.value
+
 class NonrelQuery(object):
     # ----------------------------------------------
     # Public API
@@ -31,6 +60,9 @@ class NonrelQuery(object):
         self.connection = compiler.connection
         self.query = self.compiler.query
         self._negated = False
+        # id(where node) -> (where node, predicate), see _matches_filters()
+        self._filter_predicates = {}
+        self._order_spec = None
 
     def fetch(self, low_mark=0, high_mark=None):
         raise NotImplementedError('Not implemented')
@@ -134,63 +166,116 @@ class NonrelQuery(object):
         return result
 
     def _matches_filters(self, entity, filters):
+        key = id(filters)
+        if key not in self._filter_predicates:
+            self._filter_predicates[key] = (filters,
+                                            self._compile_filters(filters))
+        return self._filter_predicates[key][1](entity)
+
+    def _compile_filters(self, filters):
+        """
+        Turns a where-tree into a function which checks an entity against
+        it. The filter values get processed once per query instead of once
+        per entity.
+        """
         # Filters without rules match everything
         if not filters.children:
-            return True
-
-        result = filters.connector == AND
+            return lambda entity: True
 
+        checks = []
         for child in filters.children:
             if isinstance(child, Node):
-                submatch = self._matches_filters(entity, child)
+                checks.append(self._compile_filters(child))
             else:
-                constraint, lookup_type, annotation, value = child
-                packed, value = constraint.process(lookup_type, value, self.connection)
-                alias, column, db_type = packed
-                if alias != self.query.model._meta.db_table:
-                    raise DatabaseError("This database doesn't support JOINs "
-                                        "and multi-table inheritance.")
-
-                # Django fields always return a list (see Field.get_db_prep_lookup)
-                # except if get_db_prep_lookup got overridden by a subclass
-                if lookup_type != 'in' and isinstance(value, (tuple, list)):
-                    if len(value) > 1:
-                        raise DatabaseError('Filter lookup type was: %s. '
-                            'Expected the filters value not to be a list. '
-                            'Only "in"-filters can be used with lists.'
-                            % lookup_type)
-                    elif lookup_type == 'isnull':
-                        value = annotation
-                    else:
-                        value = value[0]
-
-                submatch = EMULATED_OPS[lookup_type](entity[column], value)
-
-            if filters.connector == OR and submatch:
-                result = True
-                break
-            elif filters.connector == AND and not submatch:
-                result = False
-                break
+                checks.append(self._compile_constraint(child))
+
+        negated = filters.negated
+        if filters.connector == OR:
+            def matches(entity):
+                for check in checks:
+                    if check(entity):
+                        return not negated
+                return negated
+        else:
+            def matches(entity):
+                for check in checks:
+                    if not check(entity):
+                        return negated
+                return not negated
+        return matches
+
+    def _compile_constraint(self, child):
+        constraint, lookup_type, annotation, value = child
+        packed, value = constraint.process(lookup_type, value, self.connection)
+        alias, column, db_type = packed
+        if alias != self.query.model._meta.db_table:
+            raise DatabaseError("This database doesn't support JOINs "
+                                "and multi-table inheritance.")
 
-        if filters.negated:
-            return not result
-        return result
+        # Django fields always return a list (see Field.get_db_prep_lookup)
+        # except if get_db_prep_lookup got overridden by a subclass
+        if lookup_type != 'in' and isinstance(value, (tuple, list)):
+            if len(value) > 1:
+                raise DatabaseError('Filter lookup type was: %s. '
+                    'Expected the filters value not to be a list. '
+                    'Only "in"-filters can be used with lists.'
+                    % lookup_type)
+            elif lookup_type == 'isnull':
+                value = annotation
+            else:
+                value = value[0]
 
-    def _order_in_memory(self, lhs, rhs):
-        for order in self.compiler._get_ordering():
-            if LOOKUP_SEP in order:
-                raise DatabaseError("JOINs in ordering not supported (%s)" % order)
-            if order == '?':
-                result = random.choice([1, 0, -1])
+        op = EMULATED_OPS[lookup_type]
+        def check(entity):
+            return op(entity[column], value)
+        return check
+
+    def _get_order_spec(self):
+        """
+        Returns (column, descending) for each ordering column, or (None,
+        False) for random ordering. Parsed once per query.
+        """
+        if self._order_spec is None:
+            spec = []
+            for order in self.compiler._get_ordering():
+                if LOOKUP_SEP in order:
+                    raise DatabaseError("JOINs in ordering not supported (%s)" % order)
+                if order == '?':
+                    spec.append((None, False))
+                else:
+                    spec.append((order.lstrip('-'), order.startswith('-')))
+            self._order_spec = spec
+        return self._order_spec
+
+    def _get_order_value(self, entity, column):
+        return entity.get(column)
+
+    def _order_key(self, entity):
+        key = []
+        for column, descending in self._get_order_spec():
+            if column is None:
+                value = random.random()
             else:
-                column = order.lstrip('-')
-                result = cmp(lhs.get(column), rhs.get(column))
-                if order.startswith('-'):
-                    result *= -1
-            if result != 0:
-                return result
-        return 0
+                value = self._get_order_value(entity, column)
+            if descending:
+                value = ReversedKey(value)
+            key.append(value)
+        return tuple(key)
+
+    def _sort_in_memory(self, entities, high_mark=None):
+        """
+        Returns the entities sorted by the query's ordering. If only the
+        first high_mark entities are needed, a heap picks them in
+        O(n log high_mark) instead of sorting all of them.
+        """
+        if not self._get_order_spec():
+            return list(entities)
+        if high_mark is not None:
+            return heapq.nsmallest(high_mark, entities, key=self._order_key)
+        return sorted(entities, key=self._order_key)
+
+    def _order_in_memory(self, lhs, rhs):
+        return cmp(self._order_key(lhs), self._order_key(rhs))
 
     def convert_value_from_db(self, db_type, value):
         return self.compiler.convert_value_from_db(db_type, value)
@@ -204,6 +289,8 @@ class NonrelCompiler(SQLCompiler):
     and ordering. Entities are assumed to be dictionaries where the keys are
     column names.
     """
+    # (fields, conversion plan) of the last _make_result() call
+    _result_plan = None
 
     # ----------------------------------------------
     # Public API
@@ -246,16 +333,38 @@ class NonrelCompiler(SQLCompiler):
     # ----------------------------------------------
     def _make_result(self, entity, fields):
         result = []
-        for field in fields:
-            value = entity.get(field.column, NOT_PROVIDED)
+        for column, field, nullable, convert in self._get_result_plan(fields):
+            value = entity.get(column, NOT_PROVIDED)
             if value is NOT_PROVIDED:
                 value = field.get_default()
-            if value is None and not field.null:
+            if value is None and not nullable:
                 raise DatabaseError("Non-nullable field %s can't be None!" % field.name)
-            value = self.convert_value_from_db(field.db_type(connection=self.connection), value)
-            result.append(value)
+            result.append(convert(value))
         return result
 
+    def _get_result_plan(self, fields):
+        """
+        Returns (column, field, nullable, converter) for each of the fields.
+        The converters get picked once per query instead of once per value.
+        """
+        if self._result_plan is None or self._result_plan[0] is not fields:
+            plan = []
+            for field in fields:
+                db_type = field.db_type(connection=self.connection)
+                plan.append((field.column, field, field.null,
+                             self.get_value_converter(db_type)))
+            self._result_plan = (fields, plan)
+        return self._result_plan[1]
+
+    def get_value_converter(self, db_type):
+        """
+        Returns a function which converts a value of the given db_type like
+        convert_value_from_db(). Backends can return specialized functions.
+        """
+        def convert(value):
+            return self.convert_value_from_db(db_type, value)
+        return convert
+
     def check_query(self):
         if (len([a for a in self.query.alias_map if self.query.alias_refcount[a]]) > 1
                 or self.query.distinct or self.query.extra or self.query.having):
@@ -348,6 +457,19 @@ class NonrelCompiler(SQLCompiler):
 
 class NonrelInsertCompiler(object):
     def execute_sql(self, return_id=False):
+        return self.insert(self.get_insert_data(), return_id=return_id)
+
+    def execute_many(self, compilers):
+        """
+        Inserts the rows of the given insert compilers (which may belong to
+        different models) and returns their ids. This default implementation
+        inserts them one by one; backends which support batch writes should
+        override it.
+        """
+        return [compiler.insert(compiler.get_insert_data(), return_id=True)
+                for compiler in compilers]
+
+    def get_insert_data(self):
         data = {}
         for (field, value), column in zip(self.query.values, self.query.columns):
             if field is not None:
@@ -357,7 +479,7 @@ class NonrelInsertCompiler(object):
                 db_type = field.db_type(connection=self.connection)
                 value = self.convert_value_for_db(db_type, value)
             data[column] = value
-        return self.insert(data, return_id=return_id)
+        return data
 
 class NonrelUpdateCompiler(object):
     def execute_sql(self, result_type=MULTI):
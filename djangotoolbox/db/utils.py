@@ -0,0 +1,63 @@
+from django.db import connections, router
+from django.db.models import signals
+from django.db.models.fields import AutoField
+from django.db.models.sql.subqueries import InsertQuery
+
+def bulk_create(objs, using=None):
+    """
+    Inserts new model instances, which may be of different models, with as
+    few round trips as the backend supports (e.g., one batch put on App
+    Engine) and sets their primary keys.
+
+    Like QuerySet.bulk_create() in later Django versions, this doesn't call
+    the models' save() methods. pre_save and post_save get sent, though.
+    Multi-table inheritance and proxy models aren't supported.
+    """
+    groups = []
+    for obj in objs:
+        meta = obj._meta
+        if meta.parents or meta.proxy:
+            raise ValueError("bulk_create() doesn't support inherited or "
+                             "proxy models.")
+        db = using or router.db_for_write(obj.__class__, instance=obj)
+        for group_db, group in groups:
+            if group_db == db:
+                group.append(obj)
+                break
+        else:
+            groups.append((db, [obj]))
+
+    for db, group in groups:
+        connection = connections[db]
+        compilers = []
+        for obj in group:
+            meta = obj._meta
+            signals.pre_save.send(sender=obj.__class__, instance=obj,
+                                  raw=False, using=db)
+            fields = meta.local_fields
+            if obj._get_pk_val(meta) is None:
+                fields = [f for f in fields if not isinstance(f, AutoField)]
+            values = [(f, f.get_db_prep_save(f.pre_save(obj, True),
+                                             connection=connection))
+                      for f in fields]
+            query = InsertQuery(obj.__class__)
+            query.insert_values(values)
+            compilers.append(query.get_compiler(using=db))
+
+        if hasattr(compilers[0], 'execute_many'):
+            ids = compilers[0].execute_many(compilers)
+        else:
+            ids = [compiler.execute_sql(return_id=True)
+                   for compiler in compilers]
+
+        for obj, pk in zip(group, ids):
+            meta = obj._meta
+            if meta.has_auto_field and obj._get_pk_val(meta) is None:
+                setattr(obj, meta.pk.attname, pk)
+            obj._state.db = db
+            obj._state.adding = False
+            signals.post_save.send(sender=obj.__class__, instance=obj,
+                                   created=True, raw=False, using=db)
+            obj._entity_exists = True
+            obj._original_pk = obj.pk
+    return objs
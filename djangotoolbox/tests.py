@@ -1,4 +1,6 @@
 from .fields import ListField, SetField, DictField, EmbeddedModelField
+from .db.basecompiler import NonrelQuery
+from .db.utils import bulk_create
 from django.db import models, connections
 from django.db.models import Q
 from django.db.models.signals import post_save
@@ -287,6 +289,27 @@ class SignalTest(TestCase):
         list(qs.select_related())[0].save()
         self.assertEqual(created, [True, False, False, False, False])
 
+class BulkCreateTest(TestCase):
+    def test_bulk_create(self):
+        created = []
+        @receiver(post_save, sender=Target)
+        def handle(**kwargs):
+            created.append(kwargs['created'])
+        targets = [Target(index=index) for index in range(3)]
+        other = SetModel(setfield=set([1, 2]))
+        bulk_create(targets + [other])
+        self.assertEqual(created, [True, True, True])
+        self.assertEqual(len(set([target.pk for target in targets])), 3)
+        self.assertEqual(sorted([target.index for target in Target.objects.all()]),
+                         [0, 1, 2])
+        self.assertEqual(SetModel.objects.get(pk=other.pk).setfield, set([1, 2]))
+
+        # saving afterwards updates instead of inserting again
+        targets[0].index = 5
+        targets[0].save()
+        self.assertEqual(Target.objects.count(), 3)
+        self.assertEqual(Target.objects.get(pk=targets[0].pk).index, 5)
+
 class SelectRelatedTest(TestCase):
     def test_select_related(self):
         target = Target(index=5)
@@ -298,3 +321,69 @@ class SelectRelatedTest(TestCase):
         source = Source.objects.all().select_related('target')[0]
         self.assertEqual(source.target.pk, target.pk)
         self.assertEqual(source.target.index, target.index)
+
+class InMemoryQueryTest(TestCase):
+    """
+    Tests the filter matching and ordering which backends use for entities
+    they can't filter or sort natively.
+    """
+    entities = [{'id': 1, 'floating_point': 2.0},
+                {'id': 2, 'floating_point': 2.0},
+                {'id': 3, 'floating_point': None},
+                {'id': 4, 'floating_point': 1.0},
+                {'id': 5, 'floating_point': 9.1}]
+
+    def make_query(self, queryset):
+        compiler = queryset.query.get_compiler(using=queryset.db)
+        return NonrelQuery(compiler, compiler.get_fields())
+
+    def matching_ids(self, queryset):
+        query = self.make_query(queryset)
+        return [entity['id'] for entity in self.entities
+                if entity['floating_point'] is not None and
+                query._matches_filters(entity, queryset.query.where)]
+
+    def sorted_ids(self, queryset, high_mark=None):
+        query = self.make_query(queryset)
+        return [entity['id'] for entity in
+                query._sort_in_memory(self.entities, high_mark)]
+
+    def test_or_filter(self):
+        self.assertEqual(self.matching_ids(ListModel.objects.filter(
+            Q(floating_point=1.0) | Q(floating_point__gt=9))), [4, 5])
+
+    def test_negated_filter(self):
+        self.assertEqual(self.matching_ids(ListModel.objects.exclude(
+            floating_point__lt=2)), [1, 2, 5])
+        self.assertEqual(self.matching_ids(ListModel.objects.exclude(
+            Q(floating_point=1.0) | Q(floating_point__gt=9))), [1, 2])
+        self.assertEqual(self.matching_ids(ListModel.objects.filter(
+            floating_point__gte=2).exclude(floating_point=9.1)), [1, 2])
+
+    def test_mixed_ordering(self):
+        # None sorts before any other value
+        self.assertEqual(self.sorted_ids(ListModel.objects.order_by(
+            'floating_point', '-id')), [3, 4, 2, 1, 5])
+        self.assertEqual(self.sorted_ids(ListModel.objects.order_by(
+            '-floating_point', 'id')), [5, 1, 2, 4, 3])
+
+    def test_top_k(self):
+        for ordering in (('floating_point',), ('-floating_point', 'id'),
+                         ('floating_point', '-id')):
+            queryset = ListModel.objects.order_by(*ordering)
+            ids = self.sorted_ids(queryset)
+            for high_mark in range(len(self.entities) + 1):
+                self.assertEqual(self.sorted_ids(queryset, high_mark),
+                                 ids[:high_mark])
+
+    def test_sliced_pk_query(self):
+        pks = []
+        for value in (2.0, 9.1, 1.0):
+            entity = ListModel(floating_point=value, names=[u'Naruto'])
+            entity.save()
+            pks.append(entity.pk)
+        queryset = ListModel.objects.filter(pk__in=pks)
+        self.assertEqual([entity.floating_point for entity in
+                          queryset.order_by('-floating_point')[:2]], [9.1, 2.0])
+        self.assertEqual([entity.floating_point for entity in
+                          queryset.order_by('floating_point')[1:]], [2.0, 9.1])
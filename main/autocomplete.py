@@ -0,0 +1,411 @@
+"""
+In-process title index which answers autocomplete queries from memory.
+
+The index keeps the sorted vocabulary of all words in all node titles and,
+for every word, the ids of the nodes whose title contains it. A query word
+matches the contiguous range of vocabulary words it is a prefix of, which
+bisect finds in O(log n), so a query never touches the datastore. Matching
+and ranking are the same as in main.search, which remains the fallback
+whenever the index isn't available.
+
+The index is built in pages of TITLE_INDEX_BUILD_PAGE_SIZE nodes, read
+with datastore cursors. The warmup request builds as much as fits into
+TITLE_INDEX_WARMUP_SECONDS, and every autocomplete request adds at most one
+more page, answering from the old index (or main.search) until the new one
+is done. A build which fails or runs out of memory isn't retried for
+TITLE_INDEX_RETRY_INTERVAL seconds. Once built, the index is kept current
+in two ways: saves and deletes on this instance
+update it directly, and changes made by other instances are replayed from
+the changelist (ChangeNotification) at most every
+TITLE_INDEX_REFRESH_INTERVAL seconds, and only if main.search saw a change
+since the last replay. Changes which aren't in the changelist, e.g. new
+discussion nodes or re-rendered references, get picked up by the full
+rebuild after TITLE_INDEX_MAX_AGE seconds.
+
+Memory is bounded by TITLE_INDEX_MAX_BYTES. The index tracks an estimate
+of its own size and disables itself (falling back to main.search) instead
+of growing past the limit. Expect roughly 400 bytes per title of six
+words, i.e. about 40MB for 100,000 titles.
+"""
+from array import array
+from bisect import bisect_left, insort
+from datetime import datetime, timedelta
+import logging
+import time
+
+from django.conf import settings
+
+from djangoappengine.db.utils import get_cursor, set_cursor
+
+from main import search
+from main.models import TruthNode, ChangeNotification
+
+# rough per-object sizes in bytes, used to estimate the index's footprint
+STRING_OVERHEAD = 48
+CHAR_SIZE = 4
+# dict slot and int key
+DICT_ENTRY = 100
+LIST_SLOT = 8
+ARRAY_OVERHEAD = 64
+# datastore ids can exceed 2**31, so ids are stored as C longs, which are
+# 64 bit on App Engine
+ID_TYPECODE = 'l'
+ID_SIZE = array(ID_TYPECODE).itemsize
+
+# the change feed is read with this overlap, because a notification can
+# be dated slightly before the save it announces
+REFRESH_OVERLAP = timedelta(seconds=60)
+REFRESH_BATCH_SIZE = 200
+
+# short queries match a large part of all titles, only this many of them
+# get ranked
+MAX_RANKED = 1000
+
+def _string_size(text):
+    return STRING_OVERHEAD + CHAR_SIZE * len(text)
+
+class IndexFull(Exception):
+    pass
+
+class TitleIndex(object):
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        # sorted vocabulary and, in parallel, the node ids per word
+        self.words = []
+        self.postings = []
+        # node id -> title, and node id -> expanded title for the titles
+        # with [[node N]] references
+        self.titles = {}
+        self.rendered_titles = {}
+        self.size = 0
+        # word -> node ids while extend() bulk-loads batches
+        self._pending = None
+
+    def _grow(self, size):
+        if self.size + size > self.max_bytes:
+            raise IndexFull()
+        self.size += size
+
+    def add(self, node_id, title, rendered_title=None):
+        "adds or replaces a node, raises IndexFull if it doesn't fit"
+        self.remove(node_id)
+        if rendered_title == title or not rendered_title:
+            rendered_title = None
+        size = DICT_ENTRY + _string_size(title)
+        if rendered_title is not None:
+            size += DICT_ENTRY + _string_size(rendered_title)
+        self._grow(size)
+        self.titles[node_id] = title
+        if rendered_title is not None:
+            self.rendered_titles[node_id] = rendered_title
+
+        for word in set(search.words(rendered_title or title)):
+            index = bisect_left(self.words, word)
+            if index == len(self.words) or self.words[index] != word:
+                self._grow(_string_size(word) + 2 * LIST_SLOT + ARRAY_OVERHEAD)
+                self.words.insert(index, word)
+                self.postings.insert(index, array(ID_TYPECODE))
+            self._grow(ID_SIZE)
+            insort(self.postings[index], node_id)
+
+    def remove(self, node_id):
+        try:
+            title = self.titles.pop(node_id)
+        except KeyError:
+            return
+        rendered_title = self.rendered_titles.pop(node_id, None)
+        self.size -= DICT_ENTRY + _string_size(title)
+        if rendered_title is not None:
+            self.size -= DICT_ENTRY + _string_size(rendered_title)
+
+        for word in set(search.words(rendered_title or title)):
+            index = bisect_left(self.words, word)
+            if index < len(self.words) and self.words[index] == word:
+                self.postings[index].remove(node_id)
+                self.size -= ID_SIZE
+                # unused words stay, the next rebuild drops them
+
+    def load(self, rows):
+        """
+        Bulk-loads (id, title, rendered_title) rows into an empty index.
+        Sorting the vocabulary once is much cheaper than add() per node.
+        """
+        self.extend(rows)
+        self.finish()
+
+    def extend(self, rows):
+        """
+        Like load(), but for one batch of rows at a time. Call finish()
+        after the last batch, the index can't be searched before.
+        """
+        if self._pending is None:
+            self._pending = {}
+        postings = self._pending
+        for node_id, title, rendered_title in rows:
+            if rendered_title == title or not rendered_title:
+                rendered_title = None
+            size = DICT_ENTRY + _string_size(title)
+            if rendered_title is not None:
+                size += DICT_ENTRY + _string_size(rendered_title)
+            self._grow(size)
+            self.titles[node_id] = title
+            if rendered_title is not None:
+                self.rendered_titles[node_id] = rendered_title
+
+            for word in set(search.words(rendered_title or title)):
+                ids = postings.get(word)
+                if ids is None:
+                    self._grow(_string_size(word) + 2 * LIST_SLOT + ARRAY_OVERHEAD)
+                    ids = postings[word] = array(ID_TYPECODE)
+                self._grow(ID_SIZE)
+                ids.append(node_id)
+
+    def finish(self):
+        postings = self._pending or {}
+        self.words = sorted(postings)
+        self.postings = []
+        for word in self.words:
+            ids = postings[word]
+            self.postings.append(array(ID_TYPECODE, sorted(ids)))
+        self._pending = None
+
+    def _prefix_ids(self, prefix):
+        "returns the ids of all nodes with a word starting with prefix"
+        start = bisect_left(self.words, prefix)
+        end = bisect_left(self.words, prefix + u'\uffff', start)
+        ids = set()
+        for index in range(start, end):
+            ids.update(self.postings[index])
+        return ids
+
+    def _word_ids(self, word):
+        "returns the ids of all nodes with the exact word"
+        index = bisect_left(self.words, word)
+        if index < len(self.words) and self.words[index] == word:
+            return self.postings[index]
+        return ()
+
+    def search(self, query_words, limit):
+        matches = None
+        for word in query_words:
+            ids = self._prefix_ids(word)
+            if matches is None:
+                matches = ids
+            else:
+                matches &= ids
+            if not matches:
+                return []
+
+        if len(matches) > MAX_RANKED:
+            # whole word matches rank higher, so they get picked first
+            candidates = [node_id for node_id in
+                self._word_ids(query_words[-1]) if node_id in matches]
+            candidates = candidates[:MAX_RANKED]
+            if len(candidates) < MAX_RANKED:
+                candidates = set(candidates)
+                for node_id in matches:
+                    if len(candidates) >= MAX_RANKED:
+                        break
+                    candidates.add(node_id)
+            matches = candidates
+
+        query = u' '.join(query_words)
+        ranked = []
+        for node_id in matches:
+            title = self.titles[node_id]
+            ranked.append((search.rank(query_words, query,
+                self.rendered_titles.get(node_id, title), node_id),
+                node_id, title))
+        ranked.sort()
+        return [TruthNode(pk=node_id, title=title)
+                for key, node_id, title in ranked[:limit]]
+
+_index = None
+# when _index was built, last replayed change and main.search generation
+_built = None
+_refreshed = None
+_replayed_until = None
+_generation = None
+# the rebuild in progress, if any
+_build = None
+# set while a build step runs. if it's still set on the next request, the
+# step died, e.g. of DeadlineExceededError
+_stepping = False
+# when the last build failed, no new one starts for
+# TITLE_INDEX_RETRY_INTERVAL seconds after that
+_failed_at = None
+
+def _enabled():
+    return getattr(settings, 'TITLE_INDEX', False)
+
+class IndexBuild(object):
+    """
+    Builds a new TitleIndex one page of nodes at a time, so a rebuild
+    never has to fit into a single request.
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.replayed_until = datetime.now()
+        self.generation = search.current_generation()
+        self.index = TitleIndex(
+            getattr(settings, 'TITLE_INDEX_MAX_BYTES', 32 * 1024 * 1024))
+        self.cursor = None
+        self.done = False
+
+    def step(self):
+        "loads the next page of nodes, raises IndexFull if they don't fit"
+        page_size = getattr(settings, 'TITLE_INDEX_BUILD_PAGE_SIZE', 200)
+        nodes = set_cursor(
+            TruthNode.objects.values_list('pk', 'title', 'rendered_title'),
+            start=self.cursor)[:page_size]
+        rows = list(nodes)
+        self.index.extend(rows)
+        if len(rows) < page_size:
+            self.index.finish()
+            self.done = True
+        else:
+            self.cursor = get_cursor(nodes)
+
+def _fail(message):
+    global _build, _stepping, _failed_at
+    logging.warning('%s, retrying in %is' % (message,
+        getattr(settings, 'TITLE_INDEX_RETRY_INTERVAL', 600)))
+    _build, _stepping, _failed_at = None, False, time.time()
+
+def _disable(index):
+    global _index
+    _index = None
+    _fail('Title index exceeds %i bytes, using main.search instead'
+        % index.max_bytes)
+
+def _start_build():
+    global _build
+    if _failed_at is not None and time.time() - _failed_at < \
+            getattr(settings, 'TITLE_INDEX_RETRY_INTERVAL', 600):
+        return
+    _build = IndexBuild()
+
+def _build_step():
+    "runs the next step of the pending build and installs the finished index"
+    global _index, _built, _refreshed, _replayed_until, _generation
+    global _build, _stepping, _failed_at
+    build = _build
+    _stepping = True
+    try:
+        build.step()
+    except IndexFull:
+        _disable(build.index)
+        return
+    except Exception:
+        logging.exception('Title index build step failed')
+        _fail('Title index build failed')
+        return
+    _stepping = False
+    if not build.done:
+        return
+    index = build.index
+    logging.info('Built title index of %i nodes and %i words, ~%i bytes, in %.2fs'
+        % (len(index.titles), len(index.words), index.size,
+           time.time() - build.started))
+    _index, _build, _failed_at = index, None, None
+    _built = _refreshed = build.started
+    _replayed_until, _generation = build.replayed_until, build.generation
+
+def warm_up():
+    """
+    Builds as much of the index as fits into TITLE_INDEX_WARMUP_SECONDS,
+    user requests finish the rest one page each.
+    """
+    if not _enabled():
+        return
+    if _build is None and _index is None:
+        _start_build()
+    started = time.time()
+    while _build is not None and time.time() - started < \
+            getattr(settings, 'TITLE_INDEX_WARMUP_SECONDS', 20):
+        _build_step()
+
+def _replay_changes():
+    "applies the changelist entries other instances wrote since last time"
+    global _replayed_until, _refreshed, _generation
+    _refreshed = time.time()
+    generation = search.current_generation()
+    if generation == _generation:
+        return
+    replayed_until = datetime.now()
+
+    changes = ChangeNotification.objects.filter(
+        date__gt=_replayed_until - REFRESH_OVERLAP).order_by('date')
+    changes = list(changes[:REFRESH_BATCH_SIZE + 1])
+    if len(changes) > REFRESH_BATCH_SIZE:
+        # too far behind, start over. the current index gets served until
+        # the new one is done
+        _start_build()
+        return
+
+    changed_ids, deleted_ids = set(), set()
+    for change in changes:
+        if change.change_type == ChangeNotification.DELETE:
+            if change.deleted_node_id is not None:
+                deleted_ids.add(change.deleted_node_id)
+                changed_ids.discard(change.deleted_node_id)
+        elif change.node_id is None:
+            continue
+        elif change.change_type in (ChangeNotification.CREATE,
+                ChangeNotification.EDIT, ChangeNotification.ADD):
+            changed_ids.add(change.node_id)
+
+    for node_id in deleted_ids:
+        _index.remove(node_id)
+    try:
+        for node in TruthNode.objects.in_bulk(list(changed_ids)).values():
+            _index.add(node.pk, node.title, node.rendered_title)
+    except IndexFull:
+        _disable(_index)
+        return
+    _replayed_until, _generation = replayed_until, generation
+
+def get_index():
+    """
+    Returns this instance's current TitleIndex or None if there's none.
+    A pending rebuild advances by at most one page per call.
+    """
+    if not _enabled():
+        return None
+    if _stepping:
+        _fail('Title index build step did not finish')
+    now = time.time()
+    if _build is None and (_index is None or
+            now - _built > getattr(settings, 'TITLE_INDEX_MAX_AGE', 3600)):
+        _start_build()
+    if _build is not None:
+        _build_step()
+    elif _index is not None and \
+            now - _refreshed > getattr(settings, 'TITLE_INDEX_REFRESH_INTERVAL', 30):
+        _replay_changes()
+    return _index
+
+def complete(query, limit=15):
+    "like main.search.search, but answered from memory if possible"
+    index = get_index()
+    if index is None:
+        return search.search(query, limit)
+    query_words = search.words(query)[:search.MAX_QUERY_WORDS]
+    if not query_words:
+        return []
+    return index.search(query_words, limit)
+
+# ----------------------------------------------
+# Hooks called by main.models and main.views
+# ----------------------------------------------
+def node_saved(node):
+    if _index is None:
+        return
+    try:
+        _index.add(node.pk, node.title, node.rendered_title)
+    except IndexFull:
+        _disable(_index)
+
+def node_removed(node_id):
+    if _index is not None:
+        _index.remove(node_id)
@@ -0,0 +1,93 @@
+"""
+Sharded counters for numbers which are too expensive to count() on demand.
+
+Every counter is split over COUNTER_SHARDS datastore entities. An
+increment updates a random shard in a transaction, so concurrent writers
+rarely contend. Reading a counter costs one batch get over all shards and
+the total is cached in memcache, so it's O(1) in the number of counted
+entities. reconcile() resets a counter to an exact value and is run
+periodically by the cron_counters view to fix any drift.
+"""
+import random
+
+from google.appengine.api import datastore
+from google.appengine.api.datastore_errors import EntityNotFoundError
+
+from django.conf import settings
+from django.core.cache import cache
+
+SHARD_KIND = 'main_countershard'
+
+NODES = 'nodes'
+RELATIONSHIPS = 'relationships'
+
+def _num_shards():
+    return getattr(settings, 'COUNTER_SHARDS', 20)
+
+def _shard_key(name, index):
+    return datastore.Key.from_path(SHARD_KIND, '%s:%i' % (name, index))
+
+def _cache_key(name):
+    return 'counter:%s' % name
+
+def _generation_key(name):
+    return 'counter:%s:generation' % name
+
+def increment(name, delta=1):
+    key = _shard_key(name, random.randint(0, _num_shards() - 1))
+
+    def txn():
+        try:
+            shard = datastore.Get(key)
+        except EntityNotFoundError:
+            shard = datastore.Entity(SHARD_KIND, name=key.name())
+            shard['name'] = name
+            shard['count'] = 0
+        shard['count'] += delta
+        datastore.Put(shard)
+    datastore.RunInTransaction(txn)
+
+    # tells a concurrent get_count() that its sum may miss this increment
+    try:
+        cache.incr(_generation_key(name))
+    except ValueError:
+        pass
+    # keep the cached total current, get_count() recomputes it if it's gone
+    try:
+        if delta >= 0:
+            cache.incr(_cache_key(name), delta)
+        else:
+            cache.decr(_cache_key(name), -delta)
+    except ValueError:
+        pass
+
+def decrement(name, delta=1):
+    increment(name, -delta)
+
+def get_count(name):
+    total = cache.get(_cache_key(name))
+    if total is None:
+        generation_key = _generation_key(name)
+        cache.add(generation_key, 0)
+        generation = cache.get(generation_key)
+        keys = [_shard_key(name, index) for index in range(_num_shards())]
+        total = sum([shard['count'] for shard in datastore.Get(keys)
+                     if shard is not None])
+        cache.add(_cache_key(name), total)
+        # an increment which committed after the shards were read may have
+        # found no cached total to update. don't keep a total without it
+        if generation is None or cache.get(generation_key) != generation:
+            cache.delete(_cache_key(name))
+    return total
+
+def reconcile(name, count):
+    "overwrites the counter with an exact count"
+    shards = []
+    for index in range(_num_shards()):
+        shard = datastore.Entity(SHARD_KIND,
+            name=_shard_key(name, index).name())
+        shard['name'] = name
+        shard['count'] = index == 0 and count or 0
+        shards.append(shard)
+    datastore.Put(shards)
+    cache.set(_cache_key(name), count)
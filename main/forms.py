@@ -59,6 +59,11 @@ allowed_styles = [
     'text-align',
 ]
 
+# a Cleaner isn't thread-safe. app.yaml's runtime runs one request at a time
+# per instance, so this one can be shared
+content_cleaner = bleach.Cleaner(tags=allowed_tags, attributes=allowed_attrs,
+    styles=allowed_styles)
+
 class CreateNodeForm(forms.ModelForm):
     class Meta:
         model = TruthNode
@@ -70,8 +75,7 @@ class CreateNodeForm(forms.ModelForm):
 
     def clean_content(self):
         content = self.cleaned_data['content']
-        return bleach.clean(content, tags=allowed_tags,
-            attributes=allowed_attrs, styles=allowed_styles)
+        return content_cleaner.clean(content)
 
 class NodeRelationshipForm(forms.ModelForm):
     _missing_field = 'parent_node'
@@ -0,0 +1,312 @@
+"""
+Full-text search over node titles and content.
+
+The text of a node (its expanded title and its content with the HTML
+stripped) is split into words, stop words are dropped and the rest is
+stemmed. For every stemmed term, an index entity keyed by the term holds
+the posting list: the sorted ids of the nodes containing the term and,
+in parallel, how often each contains it. A query gets all posting lists
+of its terms with one batch get and ranks the nodes by tf-idf.
+
+Updating a node's postings touches one entity per term, so it runs in a
+deferred task (see index_node). Every node also has a document entity
+with the term counts it was indexed with, so an update only writes the
+posting lists of the terms which changed. The document carries a version
+as well: tasks indexing the same node concurrently only get to store it
+if nobody else did since they read it, the others start over.
+
+Like main.counters, this uses the low-level datastore API, because the
+posting lists are updated in transactions and mustn't be indexed.
+"""
+from bisect import bisect_left
+import math
+import re
+
+from google.appengine.api import datastore
+from google.appengine.api.datastore_errors import EntityNotFoundError
+
+from html5lib.tokenizer import HTMLTokenizer
+from html5lib.constants import tokenTypes
+
+from main import counters
+from main.models import TruthNode
+
+POSTINGS_KIND = 'main_searchpostings'
+DOCUMENT_KIND = 'main_searchdocument'
+
+# words in titles count this often
+TITLE_WEIGHT = 3
+# terms contained in more nodes than this don't tell the nodes apart. a
+# query ignores them unless it has no other terms
+MAX_POSTINGS = 5000
+# beyond this, a posting list would grow too large for an entity. it gets
+# dropped for good then and the term is treated as a stop word
+MAX_STORED_POSTINGS = 40000
+MAX_QUERY_TERMS = 10
+
+word_re = re.compile(r'\w+', re.UNICODE)
+
+stop_words = frozenset('''a an and are as at be but by for from has have he
+    i if in is it its not of on or so that the their there these they this
+    to was we were what which who will with you'''.split())
+
+# tags which don't separate words
+inline_tags = frozenset(['a', 'abbr', 'acronym', 'b', 'code', 'em', 'font',
+    'i', 'span', 'strong', 'sub', 'sup', 'u'])
+skipped_tags = frozenset(['script', 'style'])
+
+# ----------------------------------------------
+# Text processing
+# ----------------------------------------------
+def plain_text(html):
+    "returns the text of an HTML fragment"
+    text = []
+    skipping = None
+    for token in HTMLTokenizer(html or u''):
+        token_type = token['type']
+        if token_type in (tokenTypes['Characters'], tokenTypes['SpaceCharacters']):
+            if skipping is None:
+                text.append(token['data'])
+        elif token_type in (tokenTypes['StartTag'], tokenTypes['EndTag'],
+                tokenTypes['EmptyTag']):
+            name = token['name'].lower()
+            if name in skipped_tags:
+                if token_type == tokenTypes['StartTag']:
+                    skipping = name
+                elif name == skipping:
+                    skipping = None
+            if name not in inline_tags:
+                text.append(u' ')
+    return u''.join(text)
+
+# (suffix, replacement, minimum stem length), longest suffixes first
+suffixes = (
+    (u'ational', u'ate', 2),
+    (u'ization', u'ize', 2),
+    (u'fulness', u'ful', 2),
+    (u'iveness', u'ive', 2),
+    (u'ousness', u'ous', 2),
+    (u'tional', u'tion', 2),
+    (u'ments', u'', 3),
+    (u'ness', u'', 3),
+    (u'ment', u'', 3),
+    (u'ably', u'able', 2),
+    (u'ings', u'', 3),
+    (u'ies', u'y', 2),
+    (u'ing', u'', 3),
+    (u'ied', u'y', 2),
+    (u'ed', u'', 3),
+    (u'ly', u'', 3),
+    (u'es', u'', 4),
+    (u's', u'', 3),
+)
+
+def stem(word):
+    """
+    A light suffix stripper in the spirit of Porter's algorithm. It
+    conflates the common inflections of English words, e.g. "argue",
+    "argues" and "argued", without a stemming library.
+    """
+    if word.endswith(u'ss') or word.endswith(u'us') or word.endswith(u'is'):
+        return word
+    for suffix, replacement, min_stem in suffixes:
+        if word.endswith(suffix) and len(word) - len(suffix) >= min_stem:
+            word = word[:-len(suffix)] + replacement
+            break
+    # so that "argue" matches "argu(ed)"
+    if word.endswith(u'e') and len(word) > 3:
+        word = word[:-1]
+    return word
+
+def terms(text):
+    "returns the index terms of a plain text, in order"
+    result = []
+    for word in word_re.findall(text.lower()):
+        if word in stop_words or len(word) > 100:
+            continue
+        result.append(stem(word))
+    return result
+
+def term_counts(node):
+    counts = {}
+    for term in terms(node.rendered_title or node.title or u''):
+        counts[term] = counts.get(term, 0) + TITLE_WEIGHT
+    for term in terms(plain_text(node.rendered_content or node.content)):
+        counts[term] = counts.get(term, 0) + 1
+    return counts
+
+# ----------------------------------------------
+# Index updates
+# ----------------------------------------------
+def _as_list(value):
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return value
+    return [value]
+
+def _postings_key(term):
+    return datastore.Key.from_path(POSTINGS_KIND, term)
+
+def _document_name(node_id):
+    return 'node:%i' % node_id
+
+def _document_key(node_id):
+    return datastore.Key.from_path(DOCUMENT_KIND, _document_name(node_id))
+
+def _update_postings(term, node_id, count):
+    "sets the count of term in node, 0 removes the node from the postings"
+    key = _postings_key(term)
+
+    def txn():
+        try:
+            postings = datastore.Get(key)
+        except EntityNotFoundError:
+            if not count:
+                return
+            postings = datastore.Entity(POSTINGS_KIND, name=term,
+                unindexed_properties=['node_ids', 'counts'])
+            postings['overflow'] = False
+        if postings.get('overflow'):
+            return
+        node_ids = list(_as_list(postings.get('node_ids')))
+        counts = list(_as_list(postings.get('counts')))
+
+        index = bisect_left(node_ids, node_id)
+        present = index < len(node_ids) and node_ids[index] == node_id
+        if count and present:
+            counts[index] = count
+        elif count:
+            node_ids.insert(index, node_id)
+            counts.insert(index, count)
+        elif present:
+            del node_ids[index]
+            del counts[index]
+        else:
+            return
+
+        if not node_ids:
+            datastore.Delete(key)
+            return
+        if len(node_ids) > MAX_STORED_POSTINGS:
+            postings['overflow'] = True
+            node_ids = counts = None
+        postings['node_ids'] = node_ids
+        postings['counts'] = counts
+        datastore.Put(postings)
+    datastore.RunInTransaction(txn)
+
+def _indexed_document(node_id):
+    "returns the version and the term counts the node was indexed with"
+    try:
+        document = datastore.Get(_document_key(node_id))
+    except EntityNotFoundError:
+        return 0, {}
+    return document.get('version', 0), dict(zip(
+        _as_list(document.get('terms')), _as_list(document.get('counts'))))
+
+def _save_document(node_id, version, counts):
+    """
+    Stores the term counts the node was indexed with. Returns False if
+    another task stored them since version was read.
+    """
+    key = _document_key(node_id)
+
+    def txn():
+        try:
+            current = datastore.Get(key).get('version', 0)
+        except EntityNotFoundError:
+            current = 0
+        if current != version:
+            return False
+        # an empty document is kept so the version keeps counting
+        document = datastore.Entity(DOCUMENT_KIND, name=_document_name(node_id),
+            unindexed_properties=['terms', 'counts', 'version'])
+        document['version'] = version + 1
+        if counts:
+            document['terms'] = counts.keys()
+            document['counts'] = counts.values()
+        datastore.Put(document)
+        return True
+    return datastore.RunInTransaction(txn)
+
+def _update(node_id, get_counts):
+    written = set()
+    while True:
+        version, old_counts = _indexed_document(node_id)
+        counts = get_counts(node_id)
+        # a concurrent task may have overwritten the postings written in an
+        # earlier attempt, so they get written again
+        for term in set(old_counts) | set(counts) | written:
+            count = counts.get(term, 0)
+            if term in written or old_counts.get(term, 0) != count:
+                _update_postings(term, node_id, count)
+                written.add(term)
+        if _save_document(node_id, version, counts):
+            return
+
+def _node_counts(node_id):
+    try:
+        node = TruthNode.objects.get(pk=node_id)
+    except TruthNode.DoesNotExist:
+        return {}
+    return term_counts(node)
+
+def _no_counts(node_id):
+    return {}
+
+def index_node(node_id):
+    """
+    Brings the index up to date with the given node. It's idempotent, so
+    it can be deferred and retried.
+    """
+    _update(node_id, _node_counts)
+
+def unindex_node(node_id):
+    _update(node_id, _no_counts)
+
+# ----------------------------------------------
+# Queries
+# ----------------------------------------------
+def search(query):
+    """
+    Returns (score, node id) tuples for all nodes containing any of the
+    query's terms, best match first. Nodes containing more of the terms
+    rank higher. Terms in more than MAX_POSTINGS nodes only count if the
+    query has no other ones.
+    """
+    query_terms = []
+    for term in terms(query or u''):
+        if term not in query_terms:
+            query_terms.append(term)
+    query_terms = query_terms[:MAX_QUERY_TERMS]
+    if not query_terms:
+        return []
+
+    lists = []
+    for postings in datastore.Get([_postings_key(term) for term in query_terms]):
+        if postings is None or postings.get('overflow'):
+            continue
+        node_ids = _as_list(postings.get('node_ids'))
+        if node_ids:
+            lists.append((node_ids, _as_list(postings.get('counts'))))
+    rare = [(node_ids, counts) for node_ids, counts in lists
+            if len(node_ids) <= MAX_POSTINGS]
+    if rare:
+        lists = rare
+
+    total = max(counters.get_count(counters.NODES), 1)
+    scores = {}
+    matched = {}
+    for node_ids, counts in lists:
+        idf = math.log(1 + float(total) / len(node_ids))
+        for node_id, count in zip(node_ids, counts):
+            scores[node_id] = scores.get(node_id, 0) + (1 + math.log(count)) * idf
+            matched[node_id] = matched.get(node_id, 0) + 1
+
+    results = []
+    for node_id, score in scores.items():
+        coverage = float(matched[node_id]) / len(query_terms)
+        results.append((score * coverage, node_id))
+    results.sort(key=lambda result: (-result[0], result[1]))
+    return results
@@ -0,0 +1,630 @@
+"""
+An optional per-instance index of the argument graph.
+
+Every NodeRelationship becomes an edge in two adjacency maps, parent ->
+children and child -> parents. Neighbor ids are kept in compact integer
+arrays and the relationship type and invert flag of each edge are packed
+into a parallel byte array. Traversals like BFS, DFS or ancestor queries
+then run in memory instead of costing one datastore query per hop.
+
+The index also maintains a topological order of the nodes (Pearce-Kelly
+dynamic topological sort). It answers "would pinning child under parent
+create a circular argument" with a single comparison in the common case.
+A search bounded to the affected part of the order is needed only when the
+new edge goes against the current order. Edges that do close a cycle are
+remembered in cyclic_edges and don't take part in the ordering.
+
+The index is kept current by the hooks below, which main.views calls
+whenever relationships change. Every change is also stored in memcache
+under the version number its writer got by incrementing the counter, and
+other instances replay the changes they missed on their next get_graph()
+call. Changes are idempotent, an
+edge is unique per (parent, child, relationship).
+
+Only an instance which missed too many changes, or whose changes were
+evicted, reloads the whole graph. The load reads
+ARGUMENT_GRAPH_BUILD_PAGE_SIZE relationships per step: the warmup request
+runs as many steps as fit into its time budget, later get_graph() calls one
+step each. Until the copy is current again, would_create_cycle() searches
+the datastore instead.
+
+It is on by default, turn it off with ARGUMENT_GRAPH_INDEX = False in settings.
+"""
+from array import array
+from collections import deque
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from djangoappengine.db.utils import fetch_async, get_cursor, set_cursor
+
+from main.models import NodeRelationship
+
+VERSION_KEY = 'argument_graph:version'
+CHANGE_KEY = 'argument_graph:change:%i'
+# changes stay in memcache this long. an instance that falls further
+# behind than MAX_CHANGES changes rebuilds its copy instead
+CHANGE_TIMEOUT = 60 * 60
+MAX_CHANGES = 1000
+# a writer stores its change right after incrementing the counter. if the
+# slot is still empty after this many seconds, the writer died in between
+SLOT_WRITE_TIMEOUT = 10
+
+# kinds of changes in the memcache change log
+ADD, REMOVE, INVERT, REMOVE_NODE = range(4)
+
+RELATIONSHIP_MASK = 0x03
+INVERT_FLAG = 0x04
+
+def pack_flags(relationship, invert_child):
+    flags = relationship & RELATIONSHIP_MASK
+    if invert_child:
+        flags |= INVERT_FLAG
+    return flags
+
+def unpack_flags(flags):
+    "returns (relationship, invert_child)"
+    return flags & RELATIONSHIP_MASK, bool(flags & INVERT_FLAG)
+
+class ArgumentGraph(object):
+    def __init__(self):
+        # node id -> array of neighbor ids and parallel array of edge flags
+        self.children = {}
+        self.child_flags = {}
+        self.parents = {}
+        self.parent_flags = {}
+        # node id -> position in the topological order
+        self.order = {}
+        self.next_order = 0
+        # (parent id, child id, relationship) of edges closing a cycle
+        self.cyclic_edges = set()
+        self.version = None
+        # when catching up first stopped at the empty slot after version
+        self.missing_since = None
+
+    # ----------------------------------------------
+    # Updates
+    # ----------------------------------------------
+    def _find(self, ids, node_id, other_id, relationship):
+        "returns the edge's position in ids[node_id] and flags, or -1"
+        node_ids = ids.get(node_id)
+        if node_ids is None:
+            return -1
+        if ids is self.children:
+            node_flags = self.child_flags[node_id]
+        else:
+            node_flags = self.parent_flags[node_id]
+        for index in range(len(node_ids)):
+            if node_ids[index] == other_id and \
+                    node_flags[index] & RELATIONSHIP_MASK == relationship:
+                return index
+        return -1
+
+    def _add(self, ids, flags, node_id, other_id, packed):
+        if node_id not in ids:
+            ids[node_id] = array('l')
+            flags[node_id] = array('B')
+        ids[node_id].append(other_id)
+        flags[node_id].append(packed)
+
+    def _remove(self, ids, flags, node_id, other_id, relationship):
+        index = self._find(ids, node_id, other_id, relationship)
+        if index < 0:
+            return
+        node_ids = ids[node_id]
+        del node_ids[index]
+        del flags[node_id][index]
+        if not node_ids:
+            del ids[node_id]
+            del flags[node_id]
+
+    def _add_order(self, node_id):
+        if node_id not in self.order:
+            self.order[node_id] = self.next_order
+            self.next_order += 1
+        return self.order[node_id]
+
+    def add_edge(self, parent_id, child_id, relationship, invert_child=False):
+        """
+        Adds the edge and returns True if it closes a cycle. Edges are
+        unique per (parent, child, relationship), adding one again only
+        updates its invert flag, so replaying a change twice is harmless.
+        """
+        packed = pack_flags(relationship, invert_child)
+        index = self._find(self.children, parent_id, child_id, relationship)
+        if index >= 0:
+            self.child_flags[parent_id][index] = packed
+            index = self._find(self.parents, child_id, parent_id, relationship)
+            self.parent_flags[child_id][index] = packed
+            return (parent_id, child_id, relationship) in self.cyclic_edges
+        cyclic = self.would_create_cycle(parent_id, child_id)
+        self._add(self.children, self.child_flags, parent_id, child_id, packed)
+        self._add(self.parents, self.parent_flags, child_id, parent_id, packed)
+        if cyclic:
+            self.cyclic_edges.add((parent_id, child_id, relationship))
+        elif self.order[parent_id] > self.order[child_id]:
+            self._reorder(parent_id, child_id)
+        return cyclic
+
+    def remove_edge(self, parent_id, child_id, relationship):
+        # removing an edge never invalidates the topological order
+        self._remove(self.children, self.child_flags, parent_id, child_id,
+            relationship)
+        self._remove(self.parents, self.parent_flags, child_id, parent_id,
+            relationship)
+        self.cyclic_edges.discard((parent_id, child_id, relationship))
+
+    def remove_node(self, node_id):
+        for child_id, flags in self.iter_children(node_id):
+            self.remove_edge(node_id, child_id, flags & RELATIONSHIP_MASK)
+        for parent_id, flags in self.iter_parents(node_id):
+            self.remove_edge(parent_id, node_id, flags & RELATIONSHIP_MASK)
+
+    def apply(self, change):
+        "replays a change another instance made, see _record()"
+        action, args = change[0], change[1:]
+        if action == ADD:
+            self.add_edge(*args)
+        elif action == REMOVE:
+            self.remove_edge(*args)
+        elif action == INVERT:
+            self.remove_edge(*args[:3])
+            self.add_edge(*args)
+        elif action == REMOVE_NODE:
+            self.remove_node(*args)
+
+    def load(self, relationships):
+        "relationships is an iterable of (parent, child, relationship, invert)"
+        self.extend(relationships)
+        self.finish()
+
+    def extend(self, relationships):
+        """
+        Like load(), but for one batch of relationships at a time. Call
+        finish() after the last batch to compute the topological order.
+        """
+        for parent_id, child_id, relationship, invert_child in relationships:
+            if self._find(self.children, parent_id, child_id,
+                    relationship) >= 0:
+                continue
+            packed = pack_flags(relationship, invert_child)
+            self._add(self.children, self.child_flags, parent_id, child_id,
+                packed)
+            self._add(self.parents, self.parent_flags, child_id, parent_id,
+                packed)
+
+    def finish(self):
+        self._sort()
+
+    def _sort(self):
+        """
+        Computes the topological order from scratch with an iterative DFS.
+        Back edges are the ones closing cycles. Without them the reverse
+        postorder is a valid topological order.
+        """
+        nodes = set(self.children) | set(self.parents)
+        postorder = []
+        # 1 while a node is on the DFS stack, 2 once it's finished
+        state = {}
+        self.cyclic_edges = set()
+        for root_id in sorted(nodes):
+            if root_id in state:
+                continue
+            state[root_id] = 1
+            stack = [(root_id, iter(self.iter_children(root_id)))]
+            while stack:
+                node_id, children = stack[-1]
+                for child_id, flags in children:
+                    child_state = state.get(child_id)
+                    if child_state is None:
+                        state[child_id] = 1
+                        stack.append((child_id,
+                            iter(self.iter_children(child_id))))
+                        break
+                    elif child_state == 1:
+                        self.cyclic_edges.add((node_id, child_id,
+                            flags & RELATIONSHIP_MASK))
+                else:
+                    state[node_id] = 2
+                    postorder.append(node_id)
+                    stack.pop()
+        postorder.reverse()
+        self.order = dict((node_id, index)
+            for index, node_id in enumerate(postorder))
+        self.next_order = len(postorder)
+
+    def _reorder(self, parent_id, child_id):
+        """
+        Restores the topological order after adding the edge parent -> child
+        with order[parent] > order[child] (Pearce-Kelly). Only the nodes whose
+        position lies between the two endpoints get moved.
+        """
+        lower = self.order[child_id]
+        upper = self.order[parent_id]
+        forward = self._bounded_search(child_id, upper, reverse=False)
+        backward = self._bounded_search(parent_id, lower, reverse=True)
+
+        by_order = lambda node_id: self.order[node_id]
+        backward.sort(key=by_order)
+        forward.sort(key=by_order)
+        moved = backward + forward
+        positions = sorted([self.order[node_id] for node_id in moved])
+        for node_id, position in zip(moved, positions):
+            self.order[node_id] = position
+
+    def _bounded_search(self, start_id, bound, reverse):
+        """
+        Returns the nodes reachable from start_id without leaving the part
+        of the order between start_id and bound. Cyclic edges are ignored.
+        """
+        seen = set([start_id])
+        stack = [start_id]
+        while stack:
+            node_id = stack.pop()
+            if reverse:
+                edges = [(other_id, node_id, flags)
+                    for other_id, flags in self.iter_parents(node_id)]
+            else:
+                edges = [(node_id, other_id, flags)
+                    for other_id, flags in self.iter_children(node_id)]
+            for parent_id, child_id, flags in edges:
+                if (parent_id, child_id, flags & RELATIONSHIP_MASK) in \
+                        self.cyclic_edges:
+                    continue
+                if reverse:
+                    other_id = parent_id
+                else:
+                    other_id = child_id
+                if other_id in seen:
+                    continue
+                position = self.order[other_id]
+                if (reverse and position > bound) or \
+                        (not reverse and position < bound):
+                    seen.add(other_id)
+                    stack.append(other_id)
+        return list(seen)
+
+    # ----------------------------------------------
+    # Queries
+    # ----------------------------------------------
+    def iter_children(self, node_id):
+        "yields (child id, packed flags) pairs"
+        return zip(self.children.get(node_id, ()),
+                   self.child_flags.get(node_id, ()))
+
+    def iter_parents(self, node_id):
+        "yields (parent id, packed flags) pairs"
+        return zip(self.parents.get(node_id, ()),
+                   self.parent_flags.get(node_id, ()))
+
+    def _adjacency(self, reverse):
+        if reverse:
+            return self.parents
+        return self.children
+
+    def bfs(self, root_id, max_depth=None, reverse=False):
+        "returns the node ids reachable from root_id in breadth-first order"
+        adjacency = self._adjacency(reverse)
+        seen = set([root_id])
+        order = [root_id]
+        queue = deque([(root_id, 0)])
+        while queue:
+            node_id, depth = queue.popleft()
+            if max_depth is not None and depth >= max_depth:
+                continue
+            for other_id in adjacency.get(node_id, ()):
+                if other_id not in seen:
+                    seen.add(other_id)
+                    order.append(other_id)
+                    queue.append((other_id, depth + 1))
+        return order
+
+    def dfs(self, root_id, reverse=False):
+        "returns the node ids reachable from root_id in depth-first preorder"
+        adjacency = self._adjacency(reverse)
+        seen = set()
+        order = []
+        stack = [root_id]
+        while stack:
+            node_id = stack.pop()
+            if node_id in seen:
+                continue
+            seen.add(node_id)
+            order.append(node_id)
+            # push in reverse so children are visited in stored order
+            stack.extend(reversed(adjacency.get(node_id, ())))
+        return order
+
+    def descendants(self, node_id):
+        return set(self.bfs(node_id)[1:])
+
+    def ancestors(self, node_id):
+        return set(self.bfs(node_id, reverse=True)[1:])
+
+    def is_reachable(self, from_id, to_id):
+        "True if to_id is a (possibly indirect) child of from_id"
+        if from_id == to_id:
+            return True
+        seen = set([from_id])
+        stack = [from_id]
+        while stack:
+            for other_id in self.children.get(stack.pop(), ()):
+                if other_id == to_id:
+                    return True
+                if other_id not in seen:
+                    seen.add(other_id)
+                    stack.append(other_id)
+        return False
+
+    def would_create_cycle(self, parent_id, child_id):
+        """
+        True if pinning child_id under parent_id would make an argument
+        depend on itself, i.e. if parent_id is reachable from child_id.
+        """
+        if parent_id == child_id:
+            return True
+        lower = self._add_order(child_id)
+        upper = self._add_order(parent_id)
+        # descendants of child always come after it in the order
+        if upper < lower:
+            return False
+        # otherwise only nodes positioned up to parent can lead there
+        seen = set([child_id])
+        stack = [child_id]
+        while stack:
+            node_id = stack.pop()
+            for other_id, flags in self.iter_children(node_id):
+                if (node_id, other_id, flags & RELATIONSHIP_MASK) in \
+                        self.cyclic_edges:
+                    continue
+                if other_id == parent_id:
+                    return True
+                if other_id not in seen and self.order[other_id] < upper:
+                    seen.add(other_id)
+                    stack.append(other_id)
+        return False
+
+    def orphans(self):
+        "ids of the nodes which have children but no parents"
+        return set(self.children) - set(self.parents)
+
+    def edge_count(self):
+        return sum([len(ids) for ids in self.children.values()])
+
+_graph = None
+# the rebuild in progress, if any
+_build = None
+# set while a build step runs. if it's still set on the next call, the step
+# died, e.g. of DeadlineExceededError
+_stepping = False
+# when the last build failed, no new one starts for
+# ARGUMENT_GRAPH_RETRY_INTERVAL seconds after that
+_failed_at = None
+
+def _enabled():
+    return getattr(settings, 'ARGUMENT_GRAPH_INDEX', False)
+
+def _current_version():
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        # start above the slots of a lost counter, whose changes may
+        # still be in memcache
+        cache.add(VERSION_KEY, int(time.time()) * 1000)
+        version = cache.get(VERSION_KEY)
+    return version
+
+def _catch_up(graph, version):
+    """
+    Replays the changes graph missed up to version. Stops before a slot
+    whose writer hasn't stored its change yet. Returns False if changes
+    aren't in memcache anymore, graph has to be rebuilt then.
+    """
+    if graph.version == version:
+        graph.missing_since = None
+        return True
+    if graph.version is None or version < graph.version or \
+            version - graph.version > MAX_CHANGES:
+        return False
+    keys = [CHANGE_KEY % slot for slot in range(graph.version + 1, version + 1)]
+    changes = cache.get_many(keys)
+    applied = 0
+    for key in keys:
+        if key not in changes:
+            break
+        graph.apply(changes[key])
+        applied += 1
+    graph.version += applied
+    if graph.version == version:
+        graph.missing_since = None
+        return True
+    now = time.time()
+    if applied or graph.missing_since is None:
+        graph.missing_since = now
+    return now - graph.missing_since <= SLOT_WRITE_TIMEOUT
+
+class GraphBuild(object):
+    """
+    Loads a new ArgumentGraph one page of relationships at a time, so a
+    rebuild never has to fit into a single request.
+    """
+    def __init__(self, version):
+        self.graph = ArgumentGraph()
+        self.version = version
+        self.cursor = None
+        self.done = False
+
+    def step(self):
+        page_size = getattr(settings, 'ARGUMENT_GRAPH_BUILD_PAGE_SIZE', 500)
+        rels = set_cursor(NodeRelationship.objects.values_list(
+            'parent_node', 'child_node', 'relationship', 'invert_child'),
+            start=self.cursor)[:page_size]
+        rows = list(rels)
+        self.graph.extend(rows)
+        if len(rows) < page_size:
+            self.graph.finish()
+            self.graph.version = self.version
+            self.done = True
+        else:
+            self.cursor = get_cursor(rels)
+
+def _fail(message):
+    global _build, _stepping, _failed_at
+    logging.warning('%s, retrying in %is' % (message,
+        getattr(settings, 'ARGUMENT_GRAPH_RETRY_INTERVAL', 600)))
+    _build, _stepping, _failed_at = None, False, time.time()
+
+def _build_step():
+    "runs the next step of the pending build and installs the finished graph"
+    global _graph, _build, _stepping, _failed_at
+    build = _build
+    _stepping = True
+    try:
+        build.step()
+    except Exception:
+        logging.exception('Argument graph build step failed')
+        _fail('Argument graph build failed')
+        return
+    _stepping = False
+    if not build.done:
+        return
+    _build = None
+    version = _current_version()
+    if version is None or not _catch_up(build.graph, version):
+        _fail('Argument graph changed too much while it was built')
+        return
+    logging.info('Built argument graph of %i edges' % build.graph.edge_count())
+    _graph, _failed_at = build.graph, None
+
+def _start_build():
+    global _build
+    if _failed_at is not None and time.time() - _failed_at < \
+            getattr(settings, 'ARGUMENT_GRAPH_RETRY_INTERVAL', 600):
+        return
+    version = _current_version()
+    if version is not None:
+        _build = GraphBuild(version)
+
+def get_graph():
+    """
+    Returns the current ArgumentGraph, or None if the index is disabled or
+    this instance's copy is out of date and still being rebuilt. A pending
+    rebuild advances by at most one page per call.
+    """
+    global _graph
+    if not _enabled():
+        return None
+    if _stepping:
+        _fail('Argument graph build step did not finish')
+    if _graph is not None:
+        version = _current_version()
+        if version is not None and _catch_up(_graph, version):
+            return _graph
+        # missed too much, don't keep the stale copy around
+        _graph = None
+    if _build is None:
+        _start_build()
+    if _build is not None:
+        _build_step()
+    return _graph
+
+def warm_up(seconds):
+    "builds as much of the graph as fits into seconds"
+    if not _enabled() or _graph is not None:
+        return
+    if _build is None:
+        _start_build()
+    started = time.time()
+    while _build is not None and time.time() - started < seconds:
+        _build_step()
+
+def _reaches_in_datastore(from_id, to_id, max_nodes):
+    """
+    True if to_id is a (possibly indirect) child of from_id, found with one
+    batch of queries per level of the argument. Gives up after max_nodes
+    nodes and returns None, as it can't tell.
+    """
+    seen = set([from_id])
+    level = [from_id]
+    while level:
+        # the datastore allows at most 30 values per __in filter
+        queries = [fetch_async(NodeRelationship.objects.filter(
+            parent_node__in=level[start:start + 30]).values_list(
+                'child_node', flat=True))
+            for start in range(0, len(level), 30)]
+        level = []
+        for query in queries:
+            for child_id in query.get_result():
+                if child_id == to_id:
+                    return True
+                if child_id not in seen:
+                    seen.add(child_id)
+                    level.append(child_id)
+        if len(seen) > max_nodes:
+            logging.warning('Gave up looking for a cycle through %i after %i '
+                'nodes' % (from_id, len(seen)))
+            return None
+    return False
+
+def would_create_cycle(parent_id, child_id, max_nodes=None):
+    """
+    See ArgumentGraph.would_create_cycle. Without a current index, the
+    datastore gets searched instead, up to max_nodes nodes (by default
+    CYCLE_CHECK_MAX_NODES). That search returns None if it gives up, and it
+    doesn't know which edges were flagged before, so it reports every cycle.
+    """
+    if parent_id == child_id:
+        return True
+    graph = get_graph()
+    if graph is None:
+        if max_nodes is None:
+            max_nodes = getattr(settings, 'CYCLE_CHECK_MAX_NODES', 1000)
+        return _reaches_in_datastore(child_id, parent_id, max_nodes)
+    return graph.would_create_cycle(parent_id, child_id)
+
+def _record(change):
+    """
+    Applies a change this instance made to its copy and stores it in
+    memcache under the next version, for the other instances to replay.
+    """
+    global _graph
+    if not _enabled():
+        return
+    if _current_version() is None:
+        return
+    # incrementing claims the slot, so concurrent writers never share one
+    try:
+        slot = cache.incr(VERSION_KEY)
+    except ValueError:
+        # the counter got lost, every instance reloads with the next one
+        _graph = None
+        return
+    if not cache.add(CHANGE_KEY % slot, change, CHANGE_TIMEOUT):
+        # the slot holds a change of a lost counter. nobody can replay this
+        # one, a new counter makes every instance reload
+        cache.delete(VERSION_KEY)
+        _graph = None
+        return
+    if _graph is not None and _graph.version == slot - 1:
+        _graph.apply(change)
+        _graph.version = slot
+    # otherwise the copy catches up with the earlier changes and this one
+    # on the next get_graph()
+
+# ----------------------------------------------
+# Hooks called by main.views
+# ----------------------------------------------
+def relationship_added(rel):
+    _record((ADD, rel.parent_node_id, rel.child_node_id, rel.relationship,
+        rel.invert_child))
+
+def relationship_removed(rel):
+    _record((REMOVE, rel.parent_node_id, rel.child_node_id, rel.relationship))
+
+def relationship_inverted(rel):
+    _record((INVERT, rel.parent_node_id, rel.child_node_id, rel.relationship,
+        rel.invert_child))
+
+def node_removed(node_id):
+    _record((REMOVE_NODE, node_id))
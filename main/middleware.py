@@ -0,0 +1,6 @@
+from main import titles
+
+class TitleResolverMiddleware(object):
+    """Gives every request a fresh set of primed node titles"""
+    def process_request(self, request):
+        titles.reset()
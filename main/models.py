@@ -1,4 +1,6 @@
 from django.db import models
+from django.utils.safestring import mark_safe
+from djangotoolbox.fields import ListField
 from richtext.fields import AdminRichTextField
 
 class TruthNode(models.Model):
@@ -9,8 +11,65 @@ class TruthNode(models.Model):
     create_date = models.DateTimeField(auto_now_add=True)
     edit_date = models.DateTimeField(auto_now=True)
 
+    # title and content with [[node N]] references expanded at save time.
+    # see rerenderReferrers() in main.views for how they're kept current.
+    rendered_title = models.TextField(blank=True, editable=False)
+    linked_title = models.TextField(blank=True, editable=False)
+    rendered_content = models.TextField(blank=True, editable=False)
+    # ids of the nodes referenced by title and content
+    referenced_nodes = ListField(models.IntegerField(), editable=False)
+    # case-folded word prefixes of the expanded title, see main.search
+    search_tokens = ListField(models.CharField(max_length=50), editable=False)
+
     def __unicode__(self):
         return self.title
+
+    def render(self):
+        from main import titles
+        titles.prime([self.title, self.content])
+        self.rendered_title = titles.expand(self.title)
+        self.linked_title = titles.expand(self.title, hyperlink=True)
+        self.rendered_content = titles.expand(self.content, hyperlink=True)
+        self.referenced_nodes = sorted(titles.referenced_ids(self.title) |
+            titles.referenced_ids(self.content))
+
+    def save(self, *args, **kwargs):
+        """
+        Pass touch=False for maintenance saves (re-rendering, re-indexing)
+        which shouldn't update edit_date.
+        """
+        from main import search, autocomplete
+        touch = kwargs.pop('touch', True)
+        self.render()
+        search.index_node(self)
+
+        edit_date = self._meta.get_field('edit_date')
+        edit_date.auto_now = touch
+        try:
+            super(TruthNode, self).save(*args, **kwargs)
+        finally:
+            edit_date.auto_now = True
+        search.changed()
+        autocomplete.node_saved(self)
+
+    # nodes saved before rendering was introduced get expanded on the fly
+    def title_html(self):
+        if self.rendered_title:
+            return mark_safe(self.rendered_title)
+        from main import titles
+        return mark_safe(titles.expand(self.title))
+
+    def linked_title_html(self):
+        if self.rendered_title:
+            return mark_safe(self.linked_title)
+        from main import titles
+        return mark_safe(titles.expand(self.title, hyperlink=True))
+
+    def content_html(self):
+        if self.rendered_title:
+            return mark_safe(self.rendered_content)
+        from main import titles
+        return mark_safe(titles.expand(self.content, hyperlink=True))
     
 class NodeRelationship(models.Model):
     PRO, CON, PREMISE = range(3)
@@ -63,8 +122,40 @@ class ChangeNotification(models.Model):
     parent_node = models.ForeignKey(TruthNode, blank=True, null=True,
         related_name="changenotification_parent_node_set")
     parent_node_title = models.CharField(max_length=200, blank=True, null=True)
+    # id of the node a DELETE is about. not a ForeignKey, as deleting the
+    # node would delete this change, too
+    deleted_node_id = models.IntegerField(blank=True, null=True)
     pin_type = models.IntegerField(choices=NodeRelationship.RELATIONSHIP_CHOICES, blank=True, null=True)
-    
+    # the titles above with [[node N]] references expanded at save time
+    rendered_node_title = models.TextField(blank=True, null=True, editable=False)
+    rendered_parent_node_title = models.TextField(blank=True, null=True, editable=False)
+
+    def render(self):
+        "expands the titles, call this before saving"
+        from main import titles
+        titles.prime([self.node_title, self.parent_node_title])
+        if self.node_title is not None:
+            self.rendered_node_title = titles.expand(self.node_title)
+        if self.parent_node_title is not None:
+            self.rendered_parent_node_title = titles.expand(self.parent_node_title)
+
+    def save(self, *args, **kwargs):
+        self.render()
+        super(ChangeNotification, self).save(*args, **kwargs)
+
+    # notifications saved before rendering was introduced get expanded on the fly
+    def node_title_html(self):
+        if self.rendered_node_title is not None:
+            return mark_safe(self.rendered_node_title)
+        from main import titles
+        return mark_safe(titles.expand(self.node_title))
+
+    def parent_node_title_html(self):
+        if self.rendered_parent_node_title is not None:
+            return mark_safe(self.rendered_parent_node_title)
+        from main import titles
+        return mark_safe(titles.expand(self.parent_node_title))
+
 class User(models.Model):
     INACTIVE, ACTIVE, BANNED = range(3)
     STATUS_CHOICES = (
@@ -0,0 +1,89 @@
+"""
+Pagination with datastore cursors instead of count() and offsets.
+
+django.core.paginator needs the total count and reads page N with an
+offset, so the datastore has to skip over all entities of the previous
+pages. A CursorPaginator starts every page at the cursor where the
+previous page ended. It never counts, so it only knows whether there is a
+next page, not how many pages there are.
+
+Cursors only point forward. To support "previous" links, every page stores
+the cursor it started at in memcache, keyed by the cursor of the page
+after it.
+"""
+from google.appengine.api.datastore_errors import BadValueError
+
+from django.core.cache import cache
+from django.utils.hashcompat import md5_constructor
+
+from djangoappengine.db.utils import get_cursor, set_cursor
+
+class CursorPage(object):
+    def __init__(self, object_list, number, cursor, next_cursor,
+                 previous_cursor, paginator):
+        self.object_list = object_list
+        self.number = number
+        self.cursor = cursor
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+        self.paginator = paginator
+
+    def __repr__(self):
+        return '<Page %s>' % self.number
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        # without counting, a full page is the best hint we have
+        return len(self.object_list) == self.paginator.per_page
+
+    def has_previous(self):
+        return self.number > 1
+
+    def has_other_pages(self):
+        return self.has_previous() or self.has_next()
+
+    def next_page_number(self):
+        return self.number + 1
+
+    def previous_page_number(self):
+        return self.number - 1
+
+class CursorPaginator(object):
+    def __init__(self, object_list, per_page, cache_prefix):
+        self.object_list = object_list
+        self.per_page = per_page
+        self.cache_prefix = cache_prefix
+
+    def _previous_cursor_key(self, cursor):
+        return '%s:prev:%s' % (self.cache_prefix, md5_constructor(cursor).hexdigest())
+
+    def page(self, cursor=None, number=1):
+        """
+        Returns the page starting at cursor (the first page if cursor is
+        None). number is only used for display.
+        """
+        queryset = self.object_list
+        if cursor:
+            try:
+                queryset = set_cursor(queryset, start=cursor)
+            except BadValueError:
+                # malformed cursor, start over
+                cursor, number = None, 1
+                queryset = self.object_list
+        if not cursor:
+            number = 1
+
+        queryset = queryset[:self.per_page]
+        object_list = list(queryset)
+        next_cursor = get_cursor(queryset)
+
+        previous_cursor = None
+        if cursor:
+            previous_cursor = cache.get(self._previous_cursor_key(cursor))
+        if next_cursor:
+            cache.set(self._previous_cursor_key(next_cursor), cursor or '')
+
+        return CursorPage(object_list, number, cursor, next_cursor,
+                          previous_cursor, self)
@@ -0,0 +1,129 @@
+"""
+Word-prefix search over node titles, used by the autocomplete box.
+
+Every node stores the case-folded prefixes of all words in its expanded
+title in the indexed search_tokens list. A query matches a node when
+each of its words is a prefix of some word in the title, wherever in the
+title that word is. Each query word is one equality filter on
+search_tokens, which the datastore answers with a merge join. The
+candidates are then ranked in memory.
+
+The datastore returns the candidates in key order, so only the first
+CANDIDATES of them get ranked. Titles starting with the query rank
+first, so the prefixes of the whole title are indexed too (marked with
+TITLE_PREFIX) and these candidates are fetched by a second query. Among
+the remaining matches of a very common query, better ones beyond the
+first CANDIDATES can still be missed. Raising CANDIDATES trades that for
+more entities read per keystroke.
+
+Results for short queries, which are the most common ones while typing,
+are cached in memcache. The cache is invalidated by bumping a generation
+number whenever a node is saved or deleted.
+"""
+import re
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.hashcompat import md5_constructor
+
+from djangoappengine.db.utils import fetch_async
+
+from main.models import TruthNode
+
+word_re = re.compile(r'\w+', re.UNICODE)
+
+# longer words are indexed by their first MAX_PREFIX_LENGTH characters and
+# verified in memory
+MAX_PREFIX_LENGTH = 12
+MAX_QUERY_WORDS = 5
+CANDIDATES = 50
+# marks the tokens of title prefixes. words never contain it
+TITLE_PREFIX = u'^'
+
+GENERATION_KEY = 'search:generation'
+
+def words(text):
+    return [word.lower() for word in word_re.findall(text or u'')]
+
+def index_tokens(text):
+    "returns all word and title prefixes of text which should point to it"
+    tokens = set()
+    for word in words(text):
+        for end in range(1, min(len(word), MAX_PREFIX_LENGTH) + 1):
+            tokens.add(word[:end])
+    title = (text or u'').lower()
+    for end in range(1, min(len(title), MAX_PREFIX_LENGTH) + 1):
+        tokens.add(TITLE_PREFIX + title[:end])
+    return sorted(tokens)
+
+def index_node(node):
+    "call this before saving node"
+    node.search_tokens = index_tokens(node.rendered_title or node.title)
+
+def changed():
+    "call this after a node was saved or deleted"
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:
+        cache.add(GENERATION_KEY, 1)
+
+def current_generation():
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        cache.add(GENERATION_KEY, 1)
+        generation = cache.get(GENERATION_KEY)
+    return generation
+
+def rank(query_words, query, title, node_id):
+    "sort key for a matching title, titles starting with the query come first"
+    title = title.lower()
+    title_words = words(title)
+    whole_words = len([word for word in query_words if word in title_words])
+    return (not title.startswith(query), -whole_words, len(title), node_id)
+
+def _search(query_words, limit):
+    query = u' '.join(query_words)
+    nodes = TruthNode.objects.all()
+    for word in query_words:
+        nodes = nodes.filter(search_tokens=word[:MAX_PREFIX_LENGTH])
+    # the candidates which rank first, whatever their keys are
+    starting = fetch_async(nodes.filter(
+        search_tokens=TITLE_PREFIX + query[:MAX_PREFIX_LENGTH])[:CANDIDATES])
+    nodes = fetch_async(nodes[:CANDIDATES])
+
+    candidates = {}
+    for node in starting.get_result() + nodes.get_result():
+        candidates.setdefault(node.pk, node)
+    results = []
+    for node in candidates.values():
+        title_words = words(node.rendered_title or node.title)
+        # words longer than the indexed prefixes need to be checked here
+        for query_word in query_words:
+            if len(query_word) > MAX_PREFIX_LENGTH and not [word
+                    for word in title_words if word.startswith(query_word)]:
+                break
+        else:
+            results.append(node)
+
+    results.sort(key=lambda node: rank(query_words, query,
+        node.rendered_title or node.title, node.pk))
+    return results[:limit]
+
+def search(query, limit=15):
+    "returns the best matching nodes for query, best match first"
+    query_words = words(query)[:MAX_QUERY_WORDS]
+    if not query_words:
+        return []
+
+    normalized = u' '.join(query_words)
+    if len(normalized) > getattr(settings, 'SEARCH_CACHE_MAX_QUERY_LENGTH', 3):
+        return _search(query_words, limit)
+
+    key = 'search:%s:%i:%s' % (current_generation(), limit,
+        md5_constructor(normalized.encode('utf-8')).hexdigest())
+    results = cache.get(key)
+    if results is None:
+        results = [(node.pk, node.title)
+                   for node in _search(query_words, limit)]
+        cache.set(key, results, getattr(settings, 'SEARCH_CACHE_TIMEOUT', 300))
+    return [TruthNode(pk=pk, title=title) for pk, title in results]
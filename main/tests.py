@@ -0,0 +1,390 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models.sql.subqueries import DeleteQuery
+from django.test import TestCase
+
+from main.models import TruthNode, NodeRelationship, ChangeNotification, User
+from main import counters, fulltext, graph, search
+from main.views import createRelationship, flagRelationship, \
+    nodeViewCacheKey, recount
+
+import os
+import simplejson as json
+
+class DeleteNodeTest(TestCase):
+    email = 'tester@example.com'
+
+    def setUp(self):
+        self.environ = dict(os.environ)
+        os.environ['USER_EMAIL'] = self.email
+        os.environ['USER_ID'] = '1'
+        User(email=self.email, status=User.ACTIVE).save()
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+
+    def test_delete_notification_survives(self):
+        node = TruthNode(title=u'Doomed claim')
+        node.save()
+        node_id = node.pk
+
+        self.client.post(reverse('delete', args=[node_id]))
+
+        self.assertEquals(TruthNode.objects.filter(pk=node_id).count(), 0)
+        changes = list(ChangeNotification.objects.filter(
+            change_type=ChangeNotification.DELETE))
+        self.assertEquals(len(changes), 1)
+        self.assertEquals(changes[0].deleted_node_id, node_id)
+        self.assertEquals(changes[0].node_title, u'Doomed claim')
+
+class CreateRelationshipTest(TestCase):
+    def test_duplicate_is_not_saved(self):
+        parent = TruthNode(title=u'Parent claim')
+        parent.save()
+        child = TruthNode(title=u'Child claim')
+        child.save()
+
+        rel = createRelationship(child, parent, discuss=False)
+        again = createRelationship(child, parent, discuss=False)
+
+        self.assertEquals(again.pk, rel.pk)
+        self.assertEquals(NodeRelationship.objects.filter(
+            parent_node=parent, child_node=child).count(), 1)
+
+    def test_duplicate_saves_notification(self):
+        parent = TruthNode(title=u'Parent claim')
+        parent.save()
+        child = TruthNode(title=u'Child claim')
+        child.save()
+        createRelationship(child, parent, discuss=False)
+
+        change = ChangeNotification(change_type=ChangeNotification.PIN,
+            user=u'tester', node=child, node_title=child.title,
+            parent_node=parent, parent_node_title=parent.title)
+        createRelationship(child, parent, discuss=False, save_with=[change])
+
+        self.assertNotEquals(change.pk, None)
+
+    def test_flag_without_discussion_node(self):
+        flag = TruthNode(pk=settings.FLAG_ID, title=u'Flagged claims')
+        flag.save()
+        parent = TruthNode(title=u'Parent claim')
+        parent.save()
+        child = TruthNode(title=u'Child claim')
+        child.save()
+        rel = createRelationship(child, parent, discuss=False)
+
+        flagRelationship(rel)
+
+        rel = NodeRelationship.objects.get(pk=rel.pk)
+        self.assertNotEquals(rel.discussion_node_id, None)
+        self.assertEquals(NodeRelationship.objects.filter(
+            parent_node__pk=settings.FLAG_ID,
+            child_node__pk=rel.discussion_node_id).count(), 1)
+
+class OrphanTest(TestCase):
+    def setUp(self):
+        TruthNode(pk=settings.ORPHANS_ID, title=u'Orphans').save()
+        TruthNode(pk=settings.DISCUSSION_ORPHANS_ID,
+            title=u'Discussion orphans').save()
+        self.orphans = TruthNode.objects.get(pk=settings.ORPHANS_ID)
+        self.parent = TruthNode(title=u'Parent claim')
+        self.parent.save()
+        self.child = TruthNode(title=u'Child claim')
+        self.child.save()
+
+    def test_pinning_counts_the_unpinned_orphan(self):
+        createRelationship(self.child, self.orphans, discuss=False)
+        count = counters.get_count(counters.RELATIONSHIPS)
+
+        createRelationship(self.child, self.parent, discuss=False)
+
+        self.assertEquals(NodeRelationship.objects.filter(
+            parent_node=self.orphans).count(), 0)
+        self.assertEquals(counters.get_count(counters.RELATIONSHIPS), count)
+
+    def test_pinning_invalidates_the_orphans_view(self):
+        createRelationship(self.child, self.orphans, discuss=False)
+        cache.set(nodeViewCacheKey(settings.ORPHANS_ID), 'stale')
+
+        createRelationship(self.child, self.parent, discuss=False)
+
+        self.assertEquals(cache.get(nodeViewCacheKey(settings.ORPHANS_ID)),
+            None)
+
+    def test_view_built_before_invalidation_is_not_served(self):
+        createRelationship(self.child, self.orphans, discuss=False)
+        # a reader picks the key, then a writer invalidates the view before
+        # the reader stores what it read
+        key = nodeViewCacheKey(settings.ORPHANS_ID)
+        createRelationship(self.child, self.parent, discuss=False)
+        cache.set(key, 'stale')
+
+        self.assertNotEquals(nodeViewCacheKey(settings.ORPHANS_ID), key)
+        self.assertEquals(cache.get(nodeViewCacheKey(settings.ORPHANS_ID)),
+            None)
+
+    def test_orphans_page_skips_deleted_children(self):
+        createRelationship(self.child, self.orphans, discuss=False)
+        # delete the node without cascading, like a failed deleteNode() would
+        DeleteQuery(TruthNode).delete_batch([self.child.pk], DEFAULT_DB_ALIAS)
+
+        response = self.client.get(reverse('orphans'))
+
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(list(response.context['node_rels']), [])
+
+class NodeTreeTest(TestCase):
+    def test_limit(self):
+        root = TruthNode(title=u'Root claim')
+        root.save()
+        for title in (u'Second', u'First', u'Third'):
+            child = TruthNode(title=title)
+            child.save()
+            createRelationship(child, root, discuss=False)
+
+        response = self.client.get(reverse('ajax_node_tree', args=[root.pk]),
+            {'depth': 1, 'limit': 2})
+        data = json.loads(response.content)
+
+        self.assertEquals(data['truncated'], [root.pk])
+        titles = [data['nodes'][str(data['rels'][str(rel_id)]['child'])]['title']
+            for rel_id in data['children'][str(root.pk)]]
+        self.assertEquals(titles, [u'First', u'Second'])
+
+    def test_node_budget(self):
+        root = TruthNode(title=u'Root claim')
+        root.save()
+        for index in range(3):
+            child = TruthNode(title=u'Child %i' % index)
+            child.save()
+            createRelationship(child, root, discuss=False)
+            grandchild = TruthNode(title=u'Grandchild %i' % index)
+            grandchild.save()
+            createRelationship(grandchild, child, discuss=False)
+
+        old_max_nodes = settings.SUBTREE_MAX_NODES
+        settings.SUBTREE_MAX_NODES = 3
+        try:
+            response = self.client.get(
+                reverse('ajax_node_tree', args=[root.pk]), {'depth': 3})
+        finally:
+            settings.SUBTREE_MAX_NODES = old_max_nodes
+        data = json.loads(response.content)
+
+        self.assertEquals(len(data['nodes']), 3)
+        self.assertEquals(len(data['children'][str(root.pk)]), 2)
+        self.assertTrue(root.pk in data['truncated'])
+
+class CounterTest(TestCase):
+    def test_recount(self):
+        for index in range(5):
+            TruthNode(title=u'Claim %i' % index).save()
+        counters.reconcile(counters.NODES, 0)
+
+        old_batch_size = settings.COUNTER_RECOUNT_BATCH_SIZE
+        settings.COUNTER_RECOUNT_BATCH_SIZE = 2
+        try:
+            self.assertEquals(recount(counters.NODES), 5)
+        finally:
+            settings.COUNTER_RECOUNT_BATCH_SIZE = old_batch_size
+        self.assertEquals(counters.get_count(counters.NODES), 5)
+
+    def test_increment_after_recomputing(self):
+        counters.increment(counters.RELATIONSHIPS)
+        cache.delete('counter:%s' % counters.RELATIONSHIPS)
+        self.assertEquals(counters.get_count(counters.RELATIONSHIPS), 1)
+        counters.increment(counters.RELATIONSHIPS)
+        self.assertEquals(counters.get_count(counters.RELATIONSHIPS), 2)
+
+class ArgumentGraphTest(TestCase):
+    def make_graph(self, edges):
+        argument_graph = graph.ArgumentGraph()
+        argument_graph.load([(parent_id, child_id, NodeRelationship.PRO, False)
+            for parent_id, child_id in edges])
+        return argument_graph
+
+    def assertOrdered(self, argument_graph):
+        for parent_id in argument_graph.children:
+            for child_id, flags in argument_graph.iter_children(parent_id):
+                if (parent_id, child_id, flags & graph.RELATIONSHIP_MASK) in \
+                        argument_graph.cyclic_edges:
+                    continue
+                self.assertTrue(argument_graph.order[parent_id] <
+                    argument_graph.order[child_id])
+        self.assertEquals(sorted(argument_graph.order.values()),
+            range(len(argument_graph.order)))
+
+    def test_sort(self):
+        argument_graph = self.make_graph([(1, 2), (2, 3), (1, 3), (4, 3)])
+        self.assertOrdered(argument_graph)
+        self.assertEquals(argument_graph.cyclic_edges, set())
+
+    def test_sort_skips_back_edges(self):
+        argument_graph = self.make_graph([(1, 2), (2, 3), (3, 1)])
+        self.assertEquals(len(argument_graph.cyclic_edges), 1)
+        self.assertOrdered(argument_graph)
+
+    def test_bounded_search(self):
+        argument_graph = self.make_graph([(1, 2), (2, 3), (1, 4)])
+        order = argument_graph.order
+        self.assertEquals(set(argument_graph._bounded_search(2, order[3],
+            reverse=False)), set([2]))
+        self.assertEquals(set(argument_graph._bounded_search(2, order[3] + 1,
+            reverse=False)), set([2, 3]))
+        self.assertEquals(set(argument_graph._bounded_search(3, order[1],
+            reverse=True)), set([3, 2]))
+        self.assertEquals(set(argument_graph._bounded_search(3, order[1] - 1,
+            reverse=True)), set([3, 2, 1]))
+
+    def test_reorder(self):
+        argument_graph = self.make_graph([(1, 2), (3, 4)])
+        # the load visits root 1 first, so 3 and 4 end up before 1 and 2
+        self.assertTrue(argument_graph.order[2] > argument_graph.order[3])
+        self.assertFalse(argument_graph.add_edge(2, 3, NodeRelationship.PRO))
+        self.assertOrdered(argument_graph)
+
+        self.assertTrue(argument_graph.add_edge(4, 1, NodeRelationship.PRO))
+        self.assertOrdered(argument_graph)
+
+    def test_catch_up_waits_for_pending_slot(self):
+        argument_graph = self.make_graph([(1, 2)])
+        argument_graph.version = 100
+        cache.set(graph.CHANGE_KEY % 102,
+            (graph.ADD, 2, 3, NodeRelationship.PRO, False))
+        # slot 101 is claimed, but its writer didn't store the change yet
+        self.assertTrue(graph._catch_up(argument_graph, 102))
+        self.assertEquals(argument_graph.version, 100)
+
+        cache.set(graph.CHANGE_KEY % 101,
+            (graph.ADD, 3, 4, NodeRelationship.PRO, False))
+        self.assertTrue(graph._catch_up(argument_graph, 102))
+        self.assertEquals(argument_graph.version, 102)
+        self.assertEquals(argument_graph.descendants(1), set([2, 3, 4]))
+
+class FulltextTest(TestCase):
+    def index(self, title, content=u''):
+        node = TruthNode(title=title, content=content)
+        node.save()
+        fulltext.index_node(node.pk)
+        return node
+
+    def test_stem(self):
+        self.assertEquals(fulltext.stem(u'argue'), u'argu')
+        self.assertEquals(fulltext.stem(u'argues'), u'argu')
+        self.assertEquals(fulltext.stem(u'argued'), u'argu')
+        self.assertEquals(fulltext.stem(u'ponies'), u'pony')
+        self.assertEquals(fulltext.stem(u'class'), u'class')
+        # too short to strip
+        self.assertEquals(fulltext.stem(u'bed'), u'bed')
+
+    def test_terms(self):
+        self.assertEquals(fulltext.terms(u'The Arguments were argued'),
+            [u'argu', u'argu'])
+        html = u'<p>sun<b>set</b></p><p>block</p><script>skipped</script>'
+        self.assertEquals(fulltext.terms(fulltext.plain_text(html)),
+            [u'sunset', u'block'])
+
+    def test_ranking(self):
+        both = self.index(u'Taxes are theft', u'<p>Taxes, taxes.</p>')
+        one = self.index(u'Theft of ideas')
+        self.assertEquals([node_id for score, node_id in
+            fulltext.search(u'taxes theft')], [both.pk, one.pk])
+        self.assertEquals([node_id for score, node_id in
+            fulltext.search(u'ideas')], [one.pk])
+
+    def test_reindex(self):
+        node = self.index(u'Taxes are theft')
+        node.title = u'Ideas are property'
+        node.save()
+        fulltext.index_node(node.pk)
+        self.assertEquals(fulltext.search(u'taxes'), [])
+        self.assertEquals(len(fulltext.search(u'ideas')), 1)
+
+        fulltext.unindex_node(node.pk)
+        self.assertEquals(fulltext.search(u'ideas'), [])
+
+    def test_concurrent_update(self):
+        node = self.index(u'Taxes are theft')
+        node.title = u'Ideas are property'
+        node.save()
+        version, counts = fulltext._indexed_document(node.pk)
+        calls = []
+        def get_counts(node_id):
+            if not calls:
+                # another task with an outdated copy of the node stores its
+                # postings and document in between
+                fulltext._update_postings(u'stal', node_id, 1)
+                fulltext._save_document(node_id, version, {u'stal': 1})
+            calls.append(node_id)
+            return fulltext._node_counts(node_id)
+
+        fulltext._update(node.pk, get_counts)
+
+        self.assertEquals(len(calls), 2)
+        self.assertEquals(fulltext._indexed_document(node.pk),
+            (version + 2, fulltext._node_counts(node.pk)))
+        self.assertEquals(fulltext.search(u'stale'), [])
+        self.assertEquals(fulltext.search(u'taxes'), [])
+        self.assertEquals(len(fulltext.search(u'ideas')), 1)
+
+    def test_common_terms(self):
+        rare = self.index(u'Common and rare')
+        common = self.index(u'Common only')
+        old_max_postings = fulltext.MAX_POSTINGS
+        fulltext.MAX_POSTINGS = 1
+        try:
+            self.assertEquals([node_id for score, node_id in
+                fulltext.search(u'common rare')], [rare.pk])
+            self.assertEquals(len(fulltext.search(u'common')), 2)
+        finally:
+            fulltext.MAX_POSTINGS = old_max_postings
+
+class SearchTest(TestCase):
+    def titles(self, nodes):
+        return [node.title for node in nodes]
+
+    def test_words(self):
+        self.assertEquals(search.words(u'Taxes, the THEFT!'),
+            [u'taxes', u'the', u'theft'])
+        self.assertEquals(search.words(None), [])
+
+    def test_index_tokens(self):
+        tokens = search.index_tokens(u'Tax it')
+        for token in (u't', u'ta', u'tax', u'i', u'it', u'^t', u'^tax i',
+                u'^tax it'):
+            self.assertTrue(token in tokens)
+        self.assertFalse(u'^it' in tokens)
+
+    def test_rank(self):
+        query_words = [u'theft']
+        titles = [u'Is theft ever right', u'Theftproof locks',
+            u'Taxes are theft', u'Theft is wrong']
+        titles.sort(key=lambda title: search.rank(query_words, u'theft',
+            title, 1))
+        self.assertEquals(titles, [u'Theft is wrong', u'Theftproof locks',
+            u'Taxes are theft', u'Is theft ever right'])
+
+    def test_search(self):
+        for title in (u'Is theft ever right', u'Taxes are theft',
+                u'Theft is wrong', u'Property'):
+            TruthNode(title=title).save()
+        self.assertEquals(self.titles(search.search(u'theft')),
+            [u'Theft is wrong', u'Taxes are theft', u'Is theft ever right'])
+        self.assertEquals(self.titles(search.search(u'is th')),
+            [u'Is theft ever right', u'Theft is wrong'])
+        self.assertEquals(search.search(u'  '), [])
+
+    def test_title_prefixes_beyond_candidates(self):
+        for title in (u'A claim', u'Another claim', u'Claim first'):
+            TruthNode(title=title).save()
+        old_candidates = search.CANDIDATES
+        search.CANDIDATES = 2
+        try:
+            results = search.search(u'claim')
+        finally:
+            search.CANDIDATES = old_candidates
+        self.assertEquals(self.titles(results)[0], u'Claim first')
@@ -0,0 +1,150 @@
+"""
+Resolves the node ids in [[node N]] references to node titles.
+
+Titles are looked up in three places, cheapest first: the titles primed for
+the current request, a process-level LRU cache and finally the datastore.
+Views call prime() with all the text they're about to render, so a page
+costs one batch get no matter how many references it contains.
+"""
+from functools import wraps
+from threading import local
+import re
+import time
+
+from django.conf import settings
+from django.core.urlresolvers import reverse
+
+from main.models import TruthNode
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    from django.utils.datastructures import SortedDict as OrderedDict
+
+node_expansion_re = re.compile(r'\[\[node (\d+)\]\]')
+invalid_text = 'Unknown Claim'
+html_invalid_text = '<span style="text-decoration: underline">%s</span>' % invalid_text
+
+# marks ids which don't belong to any node, so we don't look them up again
+MISSING = object()
+
+class LRUCache(object):
+    def __init__(self, size, timeout):
+        self.size = size
+        self.timeout = timeout
+        self.items = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value, expires = self.items.pop(key)
+        except KeyError:
+            return default
+        if expires < time.time():
+            return default
+        # re-insert so that the key becomes the most recently used one
+        self.items[key] = (value, expires)
+        return value
+
+    def set(self, key, value):
+        self.items.pop(key, None)
+        self.items[key] = (value, time.time() + self.timeout)
+        while len(self.items) > self.size:
+            del self.items[iter(self.items).next()]
+
+    def delete(self, key):
+        self.items.pop(key, None)
+
+_lru = LRUCache(getattr(settings, 'TITLE_CACHE_SIZE', 5000),
+    getattr(settings, 'TITLE_CACHE_TIMEOUT', 60))
+_request = local()
+
+def reset():
+    "starts a new request scope, see main.middleware.TitleResolverMiddleware"
+    _request.titles = {}
+
+def scoped(func):
+    """
+    Gives each call of func its own request scope. Use this for code which
+    runs without the middleware, e.g. deferred tasks, so that titles primed
+    by one task don't go stale in the next one on the same thread.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        reset()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            reset()
+    return wrapper
+
+def _request_titles():
+    if not hasattr(_request, 'titles'):
+        reset()
+    return _request.titles
+
+def referenced_ids(text):
+    return set(int(node_id) for node_id in node_expansion_re.findall(text or ''))
+
+def prime(texts):
+    "resolves all node references in texts with at most one batch get"
+    titles = _request_titles()
+    missing_ids = set()
+    for text in texts:
+        for node_id in referenced_ids(text):
+            if node_id in titles:
+                continue
+            title = _lru.get(node_id)
+            if title is None:
+                missing_ids.add(node_id)
+            else:
+                titles[node_id] = title
+
+    if missing_ids:
+        nodes = TruthNode.objects.in_bulk(list(missing_ids))
+        for node_id in missing_ids:
+            node = nodes.get(node_id)
+            title = MISSING if node is None else node.title
+            titles[node_id] = title
+            _lru.set(node_id, title)
+
+def get_title(node_id):
+    "returns the title of the given node or None if it doesn't exist"
+    titles = _request_titles()
+    title = titles.get(node_id)
+    if title is None:
+        title = _lru.get(node_id)
+    if title is None:
+        try:
+            title = TruthNode.objects.get(pk=node_id).title
+        except TruthNode.DoesNotExist:
+            title = MISSING
+        _lru.set(node_id, title)
+    titles[node_id] = title
+
+    if title is MISSING:
+        return None
+    return title
+
+def forget(*node_ids):
+    "call this when a node's title changes or the node gets deleted"
+    titles = _request_titles()
+    for node_id in node_ids:
+        titles.pop(node_id, None)
+        _lru.delete(node_id)
+
+def expand(text, hyperlink=False):
+    "replaces every [[node N]] in text with the title of node N"
+    def get_expansion(match):
+        try:
+            node_id = int(match.group(1))
+        except ValueError:
+            return html_invalid_text
+        title = get_title(node_id)
+        if title is None:
+            return html_invalid_text
+        title = '{%s}' % title
+        if hyperlink:
+            return '<a href="%s">%s</a>' % (reverse('node', args=[node_id]), title)
+        else:
+            return title
+    return node_expansion_re.sub(get_expansion, text or '')
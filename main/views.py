@@ -1,17 +1,29 @@
 from google.appengine.api import users
+from google.appengine.ext import deferred
 
 from django.shortcuts import render_to_response, get_object_or_404
 from django.template import RequestContext
 from django.core.urlresolvers import reverse
-from django.http import HttpResponseRedirect, HttpResponse
-from django.core.paginator import Paginator, InvalidPage, EmptyPage
+from django.http import HttpResponseRedirect, HttpResponse, Http404
+from django.core.cache import cache
 from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models.sql.subqueries import DeleteQuery
+from django.core.paginator import Paginator, InvalidPage, EmptyPage
+
+from djangoappengine.db.utils import get_cursor, set_cursor, fetch_async
+from djangoappengine.views import warmup as djangoappengine_warmup
+from djangotoolbox.db.utils import bulk_create
 
 from main.models import TruthNode, NodeRelationship, ChangeNotification, User
+from main import titles, graph, counters, search, autocomplete, fulltext
 from main.forms import CreateNodeForm, NodeRelationshipForm, NodeRelationshipFormMissingChild
+from main.paginator import CursorPaginator
 
 import simplejson as json
 from datetime import datetime
+import logging
+import time
 
 node_relationship_choices = dict(NodeRelationship.RELATIONSHIP_CHOICES)
 
@@ -34,18 +46,28 @@ def createDiscussionNode(relationship):
         node = TruthNode()
         node.title = node_title
         node.save()
+        counters.increment(counters.NODES)
     else:
         node = nodes[0]
         # unpin node from discussion orphans
-        NodeRelationship.objects.filter(parent_node__pk=settings.DISCUSSION_ORPHANS_ID, child_node__pk=node.pk).delete()
+        removeRelationships(list(NodeRelationship.objects.filter(parent_node__pk=settings.DISCUSSION_ORPHANS_ID, child_node__pk=node.pk)))
 
     relationship.discussion_node = node
 
-def createRelationship(child, parent, rel_type=NodeRelationship.PRO, invert=False, discuss=True):
+def saveTogether(*objects):
+    "saves new relationships and change notifications with one batch put"
+    for obj in objects:
+        if isinstance(obj, ChangeNotification):
+            obj.render()
+    bulk_create(objects)
+
+def buildRelationship(child, parent, rel_type=NodeRelationship.PRO, invert=False, discuss=True):
+    "returns the new relationship unsaved, see relationshipCreated()"
     # if the parent is not the orphanage, unpin from orphans
     if parent.pk != settings.ORPHANS_ID and parent.pk != settings.DISCUSSION_ORPHANS_ID:
-        NodeRelationship.objects.filter(parent_node__pk=settings.ORPHANS_ID, child_node__pk=child.pk).delete()
-        NodeRelationship.objects.filter(parent_node__pk=settings.DISCUSSION_ORPHANS_ID, child_node__pk=child.pk).delete()
+        orphan_rels = fetch_async(NodeRelationship.objects.filter(parent_node__pk=settings.ORPHANS_ID, child_node__pk=child.pk))
+        discussion_orphan_rels = fetch_async(NodeRelationship.objects.filter(parent_node__pk=settings.DISCUSSION_ORPHANS_ID, child_node__pk=child.pk))
+        removeRelationships(orphan_rels.get_result() + discussion_orphan_rels.get_result())
 
     rel = NodeRelationship()
     rel.child_node = child
@@ -54,45 +76,219 @@ def createRelationship(child, parent, rel_type=NodeRelationship.PRO, invert=Fals
     rel.invert_child = invert
     if discuss:
         createDiscussionNode(rel)
-    rel.save()
     return rel
 
-def deleteRelationship(relationship):
-    # move the discussion node to orphans
-    if relationship.discussion_node is not None:
-        createRelationship(relationship.discussion_node, TruthNode.objects.get(pk=settings.DISCUSSION_ORPHANS_ID), discuss=False)
+def relationshipCreated(rel):
+    counters.increment(counters.RELATIONSHIPS)
+    invalidateNodeViews(rel.child_node_id, rel.parent_node_id)
+    graph.relationship_added(rel)
+
+def relationshipDeleted(rel):
+    counters.decrement(counters.RELATIONSHIPS)
+    invalidateNodeViews(rel.child_node_id, rel.parent_node_id)
+    graph.relationship_removed(rel)
+
+def removeRelationships(relationships):
+    """
+    Deletes the relationships in one batch, without moving their children
+    or discussion nodes to the orphans like deleteRelationship() does.
+    """
+    if not relationships:
+        return
+    NodeRelationship.objects.filter(
+        pk__in=[rel.pk for rel in relationships]).delete()
+    for rel in relationships:
+        relationshipDeleted(rel)
+
+def existingRelationships(child_id, parent_id, rel_type=NodeRelationship.PRO):
+    "the relationships createRelationship() must not duplicate"
+    # main.graph keeps one edge per (parent, child, relationship)
+    return NodeRelationship.objects.filter(parent_node__pk=parent_id,
+        child_node__pk=child_id, relationship=rel_type)
+
+def createRelationship(child, parent, rel_type=NodeRelationship.PRO, invert=False, discuss=True, save_with=()):
+    """
+    save_with takes other new objects, e.g. the ChangeNotification, which
+    get saved in the same batch as the relationship. If the relationship
+    exists already, that one is returned. Nothing changes then, so the
+    counter and graph hooks don't run, but the save_with objects still get
+    saved, as they record what the caller did.
+    """
+    existing = list(existingRelationships(child.pk, parent.pk, rel_type)[:1])
+    if existing:
+        if save_with:
+            saveTogether(*save_with)
+        return existing[0]
+    rel = buildRelationship(child, parent, rel_type, invert, discuss)
+    saveTogether(rel, *save_with)
+    relationshipCreated(rel)
+    return rel
 
-    # if the child has no more parents, orphan it
-    if NodeRelationship.objects.filter(child_node__pk=relationship.child_node.pk).count() == 1:
-        createRelationship(relationship.child_node, TruthNode.objects.get(pk=settings.ORPHANS_ID), discuss=False)
+def flagRelationship(relationship):
+    "pins the relationship's discussion node to the flagged claims"
+    try:
+        discussion_node = relationship.discussion_node
+    except TruthNode.DoesNotExist:
+        discussion_node = None
+    if discussion_node is None:
+        # e.g. an existing relationship whose discussion node got deleted
+        createDiscussionNode(relationship)
+        relationship.save()
+        invalidateNodeViews(relationship.child_node_id, relationship.parent_node_id)
+        discussion_node = relationship.discussion_node
+    createRelationship(discussion_node,
+        TruthNode.objects.get(pk=settings.FLAG_ID), discuss=False)
+
+def checkCircularRelationship(relationship_id):
+    """
+    Flags the relationship if it closes a cycle. Pins run this as a deferred
+    task when their own, smaller search couldn't tell.
+    """
+    try:
+        relationship = NodeRelationship.objects.get(pk=relationship_id)
+    except NodeRelationship.DoesNotExist:
+        return
+    circular = graph.would_create_cycle(relationship.parent_node_id,
+        relationship.child_node_id,
+        max_nodes=settings.CYCLE_CHECK_TASK_MAX_NODES)
+    if circular is None:
+        logging.warning('Flagging relationship %i, it may be circular'
+            % relationship_id)
+    if circular is not False:
+        flagRelationship(relationship)
+
+def deleteRelationship(relationship, save_with=()):
+    # start the lookups together, so their RPCs run in parallel
+    orphanages = fetch_async(TruthNode.objects.filter(
+        pk__in=[settings.DISCUSSION_ORPHANS_ID, settings.ORPHANS_ID]))
+    child_parents = fetch_async(NodeRelationship.objects.filter(
+        child_node__pk=relationship.child_node_id).values_list('pk', flat=True)[:2])
+    # the discussion node may be an orphan already
+    discussion_orphaned = []
+    if relationship.discussion_node_id is not None:
+        discussion_orphaned = fetch_async(existingRelationships(
+            relationship.discussion_node_id, settings.DISCUSSION_ORPHANS_ID
+            ).values_list('pk', flat=True)[:1])
+    orphanages = dict((node.pk, node) for node in orphanages.get_result())
+
+    new_rels = []
+    # move the discussion node to orphans
+    if relationship.discussion_node is not None and not list(discussion_orphaned):
+        new_rels.append(buildRelationship(relationship.discussion_node, orphanages[settings.DISCUSSION_ORPHANS_ID], discuss=False))
+
+    # if the child has no more parents, orphan it. its only other orphan
+    # relationship would be the one getting deleted here
+    if len(child_parents.get_result()) == 1:
+        new_rels.append(buildRelationship(relationship.child_node, orphanages[settings.ORPHANS_ID], discuss=False))
+
+    objects = new_rels + list(save_with)
+    if objects:
+        saveTogether(*objects)
+    for rel in new_rels:
+        relationshipCreated(rel)
     
     # be gone
     relationship.delete()
+    relationshipDeleted(relationship)
+
+def prefetchRelationshipNodes(relationships, known_nodes=()):
+    """
+    Resolves the child, parent and discussion nodes of all the given
+    relationships with a single batch get and stores them in the ForeignKey
+    caches, so that rendering doesn't do one datastore get per row.
+    """
+    fields = [NodeRelationship._meta.get_field(name)
+        for name in ('child_node', 'parent_node', 'discussion_node')]
+    nodes = dict((node.pk, node) for node in known_nodes)
+
+    missing_ids = set()
+    for rel in relationships:
+        for field in fields:
+            node_id = getattr(rel, field.attname)
+            if node_id is not None and node_id not in nodes:
+                missing_ids.add(node_id)
+    nodes.update(TruthNode.objects.in_bulk(list(missing_ids)))
+
+    for rel in relationships:
+        for field in fields:
+            node = nodes.get(getattr(rel, field.attname))
+            if node is not None:
+                setattr(rel, field.get_cache_name(), node)
+    return relationships
 
 def deleteRelationships(relationships):
     for rel in relationships:
         deleteRelationship(rel)
 
 def deleteNode(node, parent_rels=None, child_rels=None):
-    # parent relationships gotta go
+    # the three queries are independent, so their RPCs run in parallel
     if parent_rels is None:
-        parent_rels = NodeRelationship.objects.filter(child_node__pk=node.pk)
+        parent_rels = fetch_async(NodeRelationship.objects.filter(child_node__pk=node.pk))
+    if child_rels is None:
+        child_rels = fetch_async(NodeRelationship.objects.filter(parent_node__pk=node.pk))
+    discussed_rels = fetch_async(NodeRelationship.objects.filter(discussion_node__pk=node.pk))
+
+    # parent relationships gotta go
     deleteRelationships(parent_rels)
 
     # children relationships gotta go
-    if child_rels is None:
-        child_rels = NodeRelationship.objects.filter(parent_node__pk=node.pk)
     deleteRelationships(child_rels)
 
     # if it's a discussion node the rel needs to be marked as not having one
-    for rel in NodeRelationship.objects.filter(discussion_node__pk=node.pk):
+    for rel in discussed_rels:
         rel.discussion_node = None
         rel.save()
+        invalidateNodeViews(rel.child_node_id, rel.parent_node_id)
 
     # run again in case code pinned it to a meta node
-    NodeRelationship.objects.filter(child_node__pk=node.pk).delete()
-    NodeRelationship.objects.filter(parent_node__pk=node.pk).delete()
+    parent_rels = fetch_async(NodeRelationship.objects.filter(child_node__pk=node.pk))
+    child_rels = fetch_async(NodeRelationship.objects.filter(parent_node__pk=node.pk))
+    removeRelationships(parent_rels.get_result() + child_rels.get_result())
     node.delete()
+    counters.decrement(counters.NODES)
+    search.changed()
+    autocomplete.node_removed(node.pk)
+    deferred.defer(fulltext.unindex_node, node.pk)
+    invalidateNodeViews(node.pk)
+    graph.node_removed(node.pk)
+    titles.forget(node.pk)
+    deferred.defer(rerenderReferrers, node.pk)
+
+@titles.scoped
+def rerenderReferrers(node_id):
+    """
+    Re-renders the nodes whose title or content references node_id. Run this
+    as a deferred task after the title of node_id changed or it got deleted.
+    """
+    titles.forget(node_id)
+    for node in TruthNode.objects.filter(referenced_nodes=node_id):
+        # re-rendering isn't an edit
+        node.save(touch=False)
+        # the node's own view and its neighbors' views show the title
+        neighbor_ids = [rel.parent_node_id for rel in
+            NodeRelationship.objects.filter(child_node__pk=node.pk)]
+        neighbor_ids += [rel.child_node_id for rel in
+            NodeRelationship.objects.filter(parent_node__pk=node.pk)]
+        invalidateNodeViews(node.pk, *neighbor_ids)
+
+@titles.scoped
+def reindexNodes(cursor=None):
+    """
+    Re-renders and re-indexes all nodes in batches, e.g. for nodes saved
+    before a derived field was introduced. Continues itself as a deferred
+    task until it has seen every node.
+    """
+    nodes = TruthNode.objects.all()
+    if cursor is not None:
+        nodes = set_cursor(nodes, start=cursor)
+    nodes = nodes[:settings.REINDEX_BATCH_SIZE]
+    for node in nodes:
+        node.save(touch=False)
+        deferred.defer(fulltext.index_node, node.pk)
+    if len(nodes) == settings.REINDEX_BATCH_SIZE:
+        deferred.defer(reindexNodes, get_cursor(nodes))
+    else:
+        logging.info('Reindexing nodes done')
 
 def admin_required(function):
     def decorated(*args, **kwargs):
@@ -118,7 +314,13 @@ def login_required(function):
     return decorated
 
 def node_children(request, template, node_id):
-    node_rels = NodeRelationship.objects.filter(parent_node__pk=node_id)
+    node_rels = list(NodeRelationship.objects.filter(parent_node__pk=node_id))
+    prefetchRelationshipNodes(node_rels)
+    # skip relationships whose child node doesn't exist anymore
+    child_cache_name = NodeRelationship._meta.get_field('child_node').get_cache_name()
+    node_rels = [rel for rel in node_rels if hasattr(rel, child_cache_name)]
+    titles.prime([rel.child_node.title for rel in node_rels
+        if not rel.child_node.rendered_title])
     return render_to_response(template, {'node_rels': node_rels}, 
         context_instance=RequestContext(request))
 
@@ -132,18 +334,24 @@ def flagged(request):
     return node_children(request, 'flagged.html', settings.FLAG_ID)
 
 def changelist(request):
-    paginator = Paginator(ChangeNotification.objects.order_by('-date'), settings.CHANGELIST_ITEMS_PER_PAGE)
+    paginator = CursorPaginator(ChangeNotification.objects.order_by('-date'),
+        settings.CHANGELIST_ITEMS_PER_PAGE, 'changelist')
 
     try:
         page = int(request.GET.get('page', '1'))
     except ValueError:
         page = 1
 
-    try:
-        changes = paginator.page(page)
-    except (EmptyPage, InvalidPage):
-        changes = paginator.page(paginator.num_pages)
-    
+    changes = paginator.page(request.GET.get('cursor'), page)
+
+    texts = []
+    for change in changes.object_list:
+        if change.rendered_node_title is None:
+            texts.append(change.node_title)
+        if change.rendered_parent_node_title is None:
+            texts.append(change.parent_node_title)
+    titles.prime(texts)
+
     context = {
         'pin_type_names': node_relationship_choices,
         'changes': changes,
@@ -151,15 +359,66 @@ def changelist(request):
     return render_to_response('changelist.html', context, 
         context_instance=RequestContext(request))
 
-def common_node(request, node_id):
-    node = get_object_or_404(TruthNode, pk=int(node_id))
-
-    parent_rels = NodeRelationship.objects.filter(child_node__pk=node.pk)
-
-    children_rels = NodeRelationship.objects.filter(parent_node__pk=node.pk)
-    pro_rels = children_rels.filter(relationship=NodeRelationship.PRO)
-    con_rels = children_rels.filter(relationship=NodeRelationship.CON)
-    premise_rels = children_rels.filter(relationship=NodeRelationship.PREMISE)
+def nodeViewGenerationKey(node_id):
+    return 'node_view:%i:generation' % int(node_id)
+
+def nodeViewCacheKey(node_id):
+    """
+    the key of the node's cached view, or None if the cache is unavailable.
+    it changes with every invalidateNodeViews(), so a view built from data
+    read before an invalidation is stored under a key nobody reads anymore
+    """
+    generation_key = nodeViewGenerationKey(node_id)
+    generation = cache.get(generation_key)
+    if generation is None:
+        # start at the current time so an evicted generation isn't reused
+        cache.add(generation_key, int(time.time() * 1000000))
+        generation = cache.get(generation_key)
+        if generation is None:
+            return None
+    return 'node_view:%i:%i' % (int(node_id), generation)
+
+def invalidateNodeViews(*node_ids):
+    "call this whenever a node or the relationships around it change"
+    for node_id in set(node_ids):
+        if node_id is None:
+            continue
+        try:
+            cache.incr(nodeViewGenerationKey(node_id))
+        except ValueError:
+            # no generation yet, the next reader starts a new one
+            pass
+
+def summarizeNode(node):
+    "a copy of node for the cached views of its neighbors, without the content"
+    return TruthNode(pk=node.pk, title=node.title,
+        rendered_title=node.rendered_title, linked_title=node.linked_title)
+
+def buildNodeView(node_id):
+    node_id = int(node_id)
+    # the three queries are independent, so their RPCs run in parallel
+    nodes = fetch_async(TruthNode.objects.filter(pk=node_id))
+    parent_rels = fetch_async(NodeRelationship.objects.filter(child_node__pk=node_id))
+    children_rels = fetch_async(NodeRelationship.objects.filter(parent_node__pk=node_id))
+    nodes = nodes.get_result()
+    if not nodes:
+        raise Http404('No TruthNode matches the given query.')
+    node = nodes[0]
+    parent_rels = parent_rels.get_result()
+    children_rels = children_rels.get_result()
+    prefetchRelationshipNodes(parent_rels + children_rels, known_nodes=[node])
+
+    # neighbors only need their titles, so keep the cached view small
+    for rel in parent_rels + children_rels:
+        for name in ('child_node', 'parent_node', 'discussion_node'):
+            cache_name = NodeRelationship._meta.get_field(name).get_cache_name()
+            if hasattr(rel, cache_name):
+                setattr(rel, cache_name, summarizeNode(getattr(rel, cache_name)))
+
+    # one query for all children, split up by relationship in memory
+    rels_by_type = dict((rel_type, []) for rel_type in node_relationship_choices)
+    for rel in children_rels:
+        rels_by_type.setdefault(rel.relationship, []).append(rel)
 
     def child_title(rel):
         return rel.child_node.title.lower()
@@ -168,13 +427,39 @@ def common_node(request, node_id):
 
     return {
         'node': node,
-        'relationship_choices': node_relationship_choices,
         'parent_rels': sorted(parent_rels, key=parent_title),
-        'pro_rels': sorted(pro_rels, key=child_title),
-        'con_rels': sorted(con_rels, key=child_title),
-        'premise_rels': sorted(premise_rels, key=child_title),
+        'pro_rels': sorted(rels_by_type[NodeRelationship.PRO], key=child_title),
+        'con_rels': sorted(rels_by_type[NodeRelationship.CON], key=child_title),
+        'premise_rels': sorted(rels_by_type[NodeRelationship.PREMISE], key=child_title),
     }
 
+def common_node(request, node_id):
+    # the key is read before the queries, so a writer invalidating the
+    # view while it's built moves the readers to another key
+    key = nodeViewCacheKey(node_id)
+    view = None
+    if key is not None:
+        view = cache.get(key)
+    if view is None:
+        view = buildNodeView(node_id)
+        if key is not None:
+            cache.set(key, view, settings.NODE_VIEW_CACHE_TIMEOUT)
+
+    # only nodes saved before rendering was introduced need expanding
+    nodes = [view['node']]
+    nodes += [rel.parent_node for rel in view['parent_rels']]
+    for key in ('pro_rels', 'con_rels', 'premise_rels'):
+        nodes += [rel.child_node for rel in view[key]]
+    texts = []
+    for node in nodes:
+        if not node.rendered_title:
+            texts += [node.title, node.content]
+    titles.prime(texts)
+
+    context = dict(view)
+    context['relationship_choices'] = node_relationship_choices
+    return context
+
 def json_response(data):
     def json_dthandler(obj):
         if isinstance(obj, datetime):
@@ -184,27 +469,91 @@ def json_response(data):
 
     return HttpResponse(json.dumps(data, default=json_dthandler), mimetype="text/plain")
 
+def pruneChangelist(before, cursor=None, deleted=0):
+    """
+    Deletes the changes older than before in fixed-size, keys-only batches.
+    If there is more to delete after CHANGELIST_PRUNE_BATCHES_PER_RUN
+    batches, a deferred task continues at the cursor where this run stopped.
+    Returns the number of changes deleted so far.
+    """
+    for batch in range(settings.CHANGELIST_PRUNE_BATCHES_PER_RUN):
+        pks = ChangeNotification.objects.filter(date__lt=before).values_list(
+            'pk', flat=True)
+        if cursor is not None:
+            pks = set_cursor(pks, start=cursor)
+        pks = pks[:settings.CHANGELIST_PRUNE_BATCH_SIZE]
+        pk_list = list(pks)
+        if not pk_list:
+            logging.info('Changelist pruning done, deleted %i changes' % deleted)
+            return deleted
+        cursor = get_cursor(pks)
+
+        # deletes by key without fetching the entities first
+        DeleteQuery(ChangeNotification).delete_batch(pk_list, DEFAULT_DB_ALIAS)
+        deleted += len(pk_list)
+
+    logging.info('Deleted %i changes so far, continuing in a new task' % deleted)
+    deferred.defer(pruneChangelist, before, cursor, deleted)
+    return deleted
+
 def cron_changelist(request):
     success = {'success': True}
+    # find the pivot with a keys-only offset query, then get just that one
     try:
-        pivot_change = ChangeNotification.objects.order_by('-date')[settings.MAX_CHANGELIST_ITEMS]
+        pivot_pk = ChangeNotification.objects.order_by('-date').values_list(
+            'pk', flat=True)[settings.MAX_CHANGELIST_ITEMS]
     except IndexError:
         # changelist is small enough
         return json_response(success)
-    
-    ChangeNotification.objects.filter(date__lt=pivot_change.date).delete()
+    pivot_change = ChangeNotification.objects.get(pk=pivot_pk)
+
+    success['deleted'] = pruneChangelist(pivot_change.date)
 
     return json_response(success)
 
+COUNTED_MODELS = {
+    counters.NODES: TruthNode,
+    counters.RELATIONSHIPS: NodeRelationship,
+}
+
+def recount(name, cursor=None, counted=0):
+    """
+    Counts the entities behind the counter name in keys-only batches and
+    reconciles the counter with the result. Like pruneChangelist(), it
+    continues in a deferred task after COUNTER_RECOUNT_BATCHES_PER_RUN
+    batches. Returns the number of entities counted so far.
+    """
+    model = COUNTED_MODELS[name]
+    for batch in range(settings.COUNTER_RECOUNT_BATCHES_PER_RUN):
+        pks = model.objects.values_list('pk', flat=True)
+        if cursor is not None:
+            pks = set_cursor(pks, start=cursor)
+        pks = pks[:settings.COUNTER_RECOUNT_BATCH_SIZE]
+        batch_size = len(pks)
+        counted += batch_size
+        if batch_size < settings.COUNTER_RECOUNT_BATCH_SIZE:
+            counters.reconcile(name, counted)
+            logging.info('Counted %i %s' % (counted, name))
+            return counted
+        cursor = get_cursor(pks)
+
+    logging.info('Counted %i %s so far, continuing in a new task'
+        % (counted, name))
+    deferred.defer(recount, name, cursor, counted)
+    return counted
+
+def cron_counters(request):
+    "recounts everything the sharded counters track, in case they drifted"
+    for name in COUNTED_MODELS:
+        deferred.defer(recount, name)
+    return json_response({'success': True})
+
 
 def ajax_search(request):
     query = request.GET.get('term')
 
-    # perform search
-    nodes = TruthNode.objects.filter(title__startswith=query)
-
-    # limit to 15 results
-    nodes = nodes[:15]
+    # perform search, limit to 15 results
+    nodes = autocomplete.complete(query, limit=15)
 
     data = []
     for node in nodes:
@@ -216,10 +565,43 @@ def ajax_search(request):
 
     return json_response(data)
 
+def search_page(request):
+    query = request.GET.get('q', '').strip()
+    results = []
+    if query:
+        results = fulltext.search(query)
+
+    paginator = Paginator(results, settings.SEARCH_RESULTS_PER_PAGE)
+    try:
+        page = int(request.GET.get('page', '1'))
+    except ValueError:
+        page = 1
+    try:
+        results = paginator.page(page)
+    except (EmptyPage, InvalidPage):
+        results = paginator.page(paginator.num_pages)
+
+    node_ids = [node_id for score, node_id in results.object_list]
+    nodes = TruthNode.objects.in_bulk(node_ids)
+    # the index may still list nodes which were deleted since
+    results.object_list = [nodes[node_id] for node_id in node_ids
+                           if node_id in nodes]
+    for node in results.object_list:
+        node.snippet = fulltext.plain_text(node.rendered_content or node.content)
+    titles.prime([node.title for node in results.object_list
+                  if not node.rendered_title])
+
+    context = {
+        'query': query,
+        'results': results,
+    }
+    return render_to_response('search.html', context,
+        context_instance=RequestContext(request))
+
 def ajax_rel(request, rel_id):
     node_rel = get_object_or_404(NodeRelationship, pk=int(rel_id))
 
-    context = common_node(request, node_rel.child_node.id)
+    context = common_node(request, node_rel.child_node_id)
     context['node_rel'] = node_rel
 
     if node_rel.invert_child:
@@ -250,6 +632,124 @@ def ajax_node_json(request, node_id):
     data['premise_rels'] = rid(data['premise_rels'])
     return json_response(data)
 
+def ajax_node_tree(request, node_id):
+    """
+    Returns the subtree rooted at node_id down to the requested depth, so the
+    client can expand several levels without further requests. Every level
+    costs one relationship query per expanded node plus one batch get. A
+    node shows its first limit relationships in key order, sorted by title.
+
+    At most SUBTREE_MAX_LEVEL_NODES new nodes get added per level and
+    SUBTREE_MAX_NODES in total. Nodes whose children didn't all fit, or
+    which didn't get expanded at all, are listed in truncated.
+    """
+    root = get_object_or_404(TruthNode, pk=int(node_id))
+
+    def int_param(name, default, maximum):
+        try:
+            value = int(request.GET.get(name, default))
+        except ValueError:
+            value = default
+        return max(0, min(value, maximum))
+    depth = int_param('depth', 2, settings.SUBTREE_MAX_DEPTH)
+    limit = int_param('limit', 20, settings.SUBTREE_MAX_CHILDREN)
+
+    child_cache_name = NodeRelationship._meta.get_field('child_node').get_cache_name()
+    nodes = {root.pk: root}
+    if not root.rendered_title:
+        titles.prime([root.title, root.content])
+    rels = {}
+    children = {}
+    truncated = []
+    frontier = [root.pk]
+    for level in range(depth):
+        # one bounded query per parent, all running in parallel. the extra
+        # relationship tells whether there are more
+        queries = [(parent_id, fetch_async(NodeRelationship.objects.filter(
+            parent_node__pk=parent_id).order_by('pk')[:limit + 1]))
+            for parent_id in frontier]
+
+        # take relationships in key order until the level's budget is used
+        budget = min(settings.SUBTREE_MAX_LEVEL_NODES,
+            settings.SUBTREE_MAX_NODES - len(nodes))
+        new_ids = set()
+        rels_by_parent = {}
+        level_rels = []
+        for parent_id, query in queries:
+            parent_rels = query.get_result()
+            if len(parent_rels) > limit:
+                truncated.append(parent_id)
+                parent_rels = parent_rels[:limit]
+            kept_rels = []
+            for rel in parent_rels:
+                if rel.child_node_id not in nodes and \
+                        rel.child_node_id not in new_ids:
+                    if len(new_ids) >= budget:
+                        break
+                    new_ids.add(rel.child_node_id)
+                kept_rels.append(rel)
+            if len(kept_rels) < len(parent_rels) and \
+                    parent_id not in truncated:
+                truncated.append(parent_id)
+            rels_by_parent[parent_id] = kept_rels
+            level_rels += kept_rels
+        prefetchRelationshipNodes(level_rels, known_nodes=nodes.values())
+
+        next_frontier = []
+        for parent_id in frontier:
+            # skip relationships whose child node doesn't exist anymore
+            parent_rels = sorted([rel for rel in rels_by_parent[parent_id]
+                    if hasattr(rel, child_cache_name)],
+                key=lambda rel: rel.child_node.title.lower())
+            children[parent_id] = [rel.pk for rel in parent_rels]
+            for rel in parent_rels:
+                rels[rel.pk] = rel
+                # stop at nodes we've already seen, debates can be circular
+                if rel.child_node_id not in nodes:
+                    nodes[rel.child_node_id] = rel.child_node
+                    next_frontier.append(rel.child_node_id)
+        # nodes saved before rendering was introduced get expanded on the
+        # fly, resolve their references with one batch get per level
+        texts = []
+        for child_id in next_frontier:
+            if not nodes[child_id].rendered_title:
+                texts += [nodes[child_id].title, nodes[child_id].content]
+        titles.prime(texts)
+        frontier = next_frontier
+        if not frontier:
+            break
+        if len(nodes) >= settings.SUBTREE_MAX_NODES:
+            if level + 1 < depth:
+                # the next level would be empty
+                truncated.extend(frontier)
+            break
+
+    data = {
+        'root': root.pk,
+        'depth': depth,
+        'nodes': {},
+        'rels': {},
+        'children': children,
+        'truncated': truncated,
+    }
+    for node in nodes.values():
+        data['nodes'][node.pk] = {
+            'title': node.title,
+            'title_html': node.title_html(),
+            'content_html': node.content_html(),
+            'create_date': node.create_date,
+            'edit_date': node.edit_date,
+        }
+    for rel in rels.values():
+        data['rels'][rel.pk] = {
+            'parent': rel.parent_node_id,
+            'child': rel.child_node_id,
+            'relationship': rel.relationship,
+            'invert_child': rel.invert_child,
+            'discussion_node': rel.discussion_node_id,
+        }
+    return json_response(data)
+
 def ajax_rel_json(request, rel_id):
     node_rel = get_object_or_404(NodeRelationship, pk=int(rel_id))
     data = {
@@ -283,15 +783,16 @@ def add_node(request):
             node.title = form.cleaned_data.get('title')
             node.content = form.cleaned_data.get('content')
             node.save()
-
-            createRelationship(child=node, parent=TruthNode.objects.get(pk=settings.ORPHANS_ID), rel_type=NodeRelationship.PRO, discuss=False)
+            counters.increment(counters.NODES)
+            deferred.defer(fulltext.index_node, node.pk)
 
             change = ChangeNotification()
             change.change_type = ChangeNotification.CREATE
             change.user = users.get_current_user().nickname()
             change.node = node
             change.node_title = node.title
-            change.save()
+
+            createRelationship(child=node, parent=TruthNode.objects.get(pk=settings.ORPHANS_ID), rel_type=NodeRelationship.PRO, discuss=False, save_with=[change])
 
             return HttpResponseRedirect(reverse('node', args=[node.id]))
     else:
@@ -313,9 +814,21 @@ def edit_node(request, node_id):
             change.node_title = node.title
             change.save()
 
+            title_changed = node.title != form.cleaned_data.get('title')
             node.title = form.cleaned_data.get('title')
             node.content = form.cleaned_data.get('content')
             node.save()
+            deferred.defer(fulltext.index_node, node.pk)
+
+            # neighbors show the title, so their views are stale as well
+            neighbor_ids = [rel.parent_node_id for rel in
+                NodeRelationship.objects.filter(child_node__pk=node.pk)]
+            neighbor_ids += [rel.child_node_id for rel in
+                NodeRelationship.objects.filter(parent_node__pk=node.pk)]
+            invalidateNodeViews(node.pk, *neighbor_ids)
+            titles.forget(node.pk)
+            if title_changed:
+                deferred.defer(rerenderReferrers, node.pk)
 
             return HttpResponseRedirect(reverse('node', args=[node.id]))
     else:
@@ -335,6 +848,8 @@ def invert(request, rel_id):
     if request.method == 'POST':
         rel.invert_child = not rel.invert_child
         rel.save()
+        invalidateNodeViews(rel.child_node_id, rel.parent_node_id)
+        graph.relationship_inverted(rel)
 
         return HttpResponseRedirect(reverse('node', args=[rel.parent_node.id]))
     else:
@@ -354,9 +869,8 @@ def unpin_node(request, node_rel_id):
         change.pin_type = relationship.relationship
         change.parent_node = relationship.parent_node
         change.parent_node_title = relationship.parent_node.title
-        change.save()
 
-        deleteRelationship(relationship)
+        deleteRelationship(relationship, save_with=[change])
 
         return HttpResponseRedirect(reverse('node', args=[relationship.parent_node.id]))
     else:
@@ -367,6 +881,17 @@ def unpin_node(request, node_rel_id):
         return render_to_response('unpin.html', context,
             context_instance=RequestContext(request))
     
+def pinChange(child, parent, rel_type):
+    change = ChangeNotification()
+    change.change_type = ChangeNotification.PIN
+    change.user = users.get_current_user().nickname()
+    change.node = child
+    change.node_title = child.title
+    change.pin_type = rel_type
+    change.parent_node = parent
+    change.parent_node_title = parent.title
+    return change
+
 @login_required
 def pin_existing(request, node_id, relationship_type):
     parent_node = get_object_or_404(TruthNode, pk=int(node_id))
@@ -375,19 +900,19 @@ def pin_existing(request, node_id, relationship_type):
     if request.method == 'POST':
         form = NodeRelationshipFormMissingChild(request.POST)
         if form.is_valid():
+            circular = graph.would_create_cycle(
+                form.cleaned_data.get('parent_node').pk,
+                form.cleaned_data.get('child_node').pk)
+            change = pinChange(form.cleaned_data.get('child_node'),
+                form.cleaned_data.get('parent_node'),
+                form.cleaned_data.get('relationship'))
             relate = createRelationship(form.cleaned_data.get('child_node'),
                 form.cleaned_data.get('parent_node'), form.cleaned_data.get('relationship'),
-                form.cleaned_data.get('invert_child'))
-
-            change = ChangeNotification()
-            change.change_type = ChangeNotification.PIN
-            change.user = users.get_current_user().nickname()
-            change.node = relate.child_node
-            change.node_title = relate.child_node.title
-            change.pin_type = relate.relationship
-            change.parent_node = relate.parent_node
-            change.parent_node_title = relate.parent_node.title
-            change.save()
+                form.cleaned_data.get('invert_child'), save_with=[change])
+            if circular:
+                flagRelationship(relate)
+            elif circular is None:
+                deferred.defer(checkCircularRelationship, relate.pk)
 
             return HttpResponseRedirect(reverse("node", args=[relate.parent_node.id]))
     else:
@@ -404,21 +929,22 @@ def pin_node(request, node_id):
     if request.method == 'POST':
         form = NodeRelationshipForm(request.POST)
         if form.is_valid():
+            circular = graph.would_create_cycle(
+                form.cleaned_data.get('parent_node').pk,
+                form.cleaned_data.get('child_node').pk)
+            change = pinChange(form.cleaned_data.get('child_node'),
+                form.cleaned_data.get('parent_node'),
+                form.cleaned_data.get('relationship'))
             relate = createRelationship(
                 form.cleaned_data.get('child_node'),
                 form.cleaned_data.get('parent_node'),
                 form.cleaned_data.get('relationship'),
-                form.cleaned_data.get('invert_child'))
-
-            change = ChangeNotification()
-            change.change_type = ChangeNotification.PIN
-            change.user = users.get_current_user().nickname()
-            change.node = relate.child_node
-            change.node_title = relate.child_node.title
-            change.pin_type = relate.relationship
-            change.parent_node = relate.parent_node
-            change.parent_node_title = relate.parent_node.title
-            change.save()
+                form.cleaned_data.get('invert_child'),
+                save_with=[change])
+            if circular:
+                flagRelationship(relate)
+            elif circular is None:
+                deferred.defer(checkCircularRelationship, relate.pk)
 
             return HttpResponseRedirect(reverse("node", args=[relate.parent_node.id]))
     else:
@@ -434,13 +960,19 @@ def delete_node(request, node_id):
     rel_types = node_relationship_choices
 
     if request.method == 'POST':
+        parent_rels = fetch_async(parent_rels)
+        child_rels = fetch_async(child_rels)
+
         change = ChangeNotification()
         change.change_type = ChangeNotification.DELETE
         change.user = users.get_current_user().nickname()
+        # other instances' title indexes need the id. it can't go into
+        # change.node, deleting the node would delete the change with it.
+        change.deleted_node_id = node.pk
         change.node_title = node.title
-        change.save()
 
         deleteNode(node, parent_rels=parent_rels, child_rels=child_rels)
+        change.save()
 
         return HttpResponseRedirect(reverse('home'))
     else:
@@ -456,19 +988,19 @@ def add_arg(request, node_id, arg_type):
             node.title = form.cleaned_data.get('title')
             node.content = form.cleaned_data.get('content')
             node.save()
-
-            relate = createRelationship(node, parent, arg_type)
+            counters.increment(counters.NODES)
+            deferred.defer(fulltext.index_node, node.pk)
 
             change = ChangeNotification()
             change.change_type = ChangeNotification.ADD
             change.user = users.get_current_user().nickname()
-            change.node = relate.child_node
-            change.node_title = relate.child_node.title
-            change.pin_type = relate.relationship
-            change.parent_node = relate.parent_node
-            change.parent_node_title = relate.parent_node.title
-            change.save()
+            change.node = node
+            change.node_title = node.title
+            change.pin_type = arg_type
+            change.parent_node = parent
+            change.parent_node_title = parent.title
 
+            createRelationship(node, parent, arg_type, save_with=[change])
 
             return HttpResponseRedirect(reverse('node', args=[parent.id]))
     else:
@@ -495,8 +1027,19 @@ def add_con(request, node_id):
 def add_premise(request, node_id):
     return add_arg(request, node_id, NodeRelationship.PREMISE)
 
+@admin_required
+def reindex_nodes(request):
+    deferred.defer(reindexNodes)
+    return json_response({'success': True})
+
+def warmup(request):
+    # build the in-memory indexes before the first requests need them
+    autocomplete.warm_up()
+    graph.warm_up(settings.ARGUMENT_GRAPH_WARMUP_SECONDS)
+    return djangoappengine_warmup(request)
+
 def about(request):
-    node_count = TruthNode.objects.count()
-    rel_count = NodeRelationship.objects.count()
+    node_count = counters.get_count(counters.NODES)
+    rel_count = counters.get_count(counters.RELATIONSHIPS)
     return render_to_response('about.html', locals(),
         context_instance=RequestContext(request))
@@ -12,6 +12,69 @@ DISCUSSION_ORPHANS_ID = 17363
 
 CHANGELIST_ITEMS_PER_PAGE = 40
 MAX_CHANGELIST_ITEMS = CHANGELIST_ITEMS_PER_PAGE * 20
+# old changes are deleted this many at a time by /cron/changelist/
+CHANGELIST_PRUNE_BATCH_SIZE = 100
+CHANGELIST_PRUNE_BATCHES_PER_RUN = 20
+
+# node pages are cached until one of their nodes or relationships changes,
+# which moves them to a new key
+NODE_VIEW_CACHE_TIMEOUT = 60 * 60 * 24
+
+# bounds for the subtree returned by /ajax/node/<id>/tree/
+SUBTREE_MAX_DEPTH = 4
+SUBTREE_MAX_CHILDREN = 50
+SUBTREE_MAX_LEVEL_NODES = 100
+SUBTREE_MAX_NODES = 200
+
+# keep an in-memory index of all relationships on every instance, see
+# main.graph. without it, every pin searches the datastore for circular
+# arguments
+ARGUMENT_GRAPH_INDEX = True
+# rebuilds read this many relationships per request, the warmup request
+# builds for at most this many seconds, and a failed build is retried after
+# this many
+ARGUMENT_GRAPH_BUILD_PAGE_SIZE = 500
+ARGUMENT_GRAPH_WARMUP_SECONDS = 10
+ARGUMENT_GRAPH_RETRY_INTERVAL = 10 * 60
+# without a current index, the check for circular arguments looks at this
+# many nodes at most while pinning. if that's not enough, a deferred task
+# checks up to CYCLE_CHECK_TASK_MAX_NODES nodes, and flags the pin if it
+# can't tell either
+CYCLE_CHECK_MAX_NODES = 1000
+CYCLE_CHECK_TASK_MAX_NODES = 50000
+
+# number of datastore entities each counter in main.counters is split over
+COUNTER_SHARDS = 20
+# the cron job recounts them in keys-only batches of this size, and
+# continues in a new task after this many batches
+COUNTER_RECOUNT_BATCH_SIZE = 1000
+COUNTER_RECOUNT_BATCHES_PER_RUN = 20
+
+# autocomplete results for queries up to this length are cached, see main.search
+SEARCH_CACHE_MAX_QUERY_LENGTH = 3
+SEARCH_CACHE_TIMEOUT = 5 * 60
+
+# answer autocomplete queries from an in-memory title index, see
+# main.autocomplete
+TITLE_INDEX = True
+TITLE_INDEX_MAX_BYTES = 40 * 1024 * 1024
+TITLE_INDEX_REFRESH_INTERVAL = 30
+TITLE_INDEX_MAX_AGE = 60 * 60
+# builds read this many nodes per request, the warmup request builds for at
+# most this many seconds, and a failed build is retried after this many
+TITLE_INDEX_BUILD_PAGE_SIZE = 200
+TITLE_INDEX_WARMUP_SECONDS = 20
+TITLE_INDEX_RETRY_INTERVAL = 10 * 60
+
+# full-text search results per page, see main.fulltext
+SEARCH_RESULTS_PER_PAGE = 20
+
+# nodes re-saved per task by /admin/reindex/
+REINDEX_BATCH_SIZE = 50
+
+# per-instance cache of the titles used to expand [[node N]] references
+TITLE_CACHE_SIZE = 5000
+TITLE_CACHE_TIMEOUT = 60
 
 # Uncomment this if you're using the high-replication datastore.
 # TODO: Once App Engine fixes the "s~" prefix mess we can remove this.
@@ -47,6 +110,7 @@ MIDDLEWARE_CLASSES = (
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'main.middleware.TitleResolverMiddleware',
 )
 
 TEMPLATE_CONTEXT_PROCESSORS = (
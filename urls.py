@@ -1,24 +1,26 @@
 from django.conf.urls.defaults import *
-from django.views.generic.simple import direct_to_template
 
 handler500 = 'djangotoolbox.errorviews.server_error'
 
 urlpatterns = patterns('',
-    url(r'^_ah/warmup$', 'djangoappengine.views.warmup'),
+    url(r'^_ah/warmup$', 'main.views.warmup'),
 
     url(r'^$', 'main.views.home', name='home'),
     url(r'^orphans/$', 'main.views.orphans', name='orphans'),
     url(r'^flagged/$', 'main.views.flagged', name='flagged'),
     url(r'^about/$', 'main.views.about', name='about'),
 
-    url(r'^search/$', direct_to_template, {'template': 'search.html'}, name='search'),
+    url(r'^search/$', 'main.views.search_page', name='search'),
 
     url(r'^cron/changelist/$', 'main.views.cron_changelist', name='cron_changelist'),
+    url(r'^cron/counters/$', 'main.views.cron_counters', name='cron_counters'),
+    url(r'^admin/reindex/$', 'main.views.reindex_nodes', name='reindex_nodes'),
 
     url(r'^ajax/rel/(\d+)/$', 'main.views.ajax_rel', name='ajax_rel'),
     url(r'^ajax/rel/(\d+)/json/$', 'main.views.ajax_rel_json', name='ajax_rel_json'),
     url(r'^ajax/node/(\d+)/$', 'main.views.ajax_node', name='ajax_node'),
     url(r'^ajax/node/(\d+)/json/$', 'main.views.ajax_node_json', name='ajax_node_json'),
+    url(r'^ajax/node/(\d+)/tree/$', 'main.views.ajax_node_tree', name='ajax_node_tree'),
     url(r'^ajax/search/$', 'main.views.ajax_search', name='ajax_search'),
 
     url(r'^changelist/$', 'main.views.changelist', name='changelist'),